@@ -19,9 +19,11 @@ from argparse import ArgumentTypeError as err
 import os
 import sqlite3
 import time
-from datetime import datetime
+from datetime import datetime, timezone
 import hashlib
 import shutil
+import gzip
+import glob
 from io import BytesIO
 # import ipdb
 import http.client
@@ -30,6 +32,13 @@ import urllib.request, urllib.parse, urllib.error
 import mimetypes
 import re
 import tempfile
+from contextlib import contextmanager
+import json
+import threading
+import random
+from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import (BrokenExecutor, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
 from PIL import Image, ImageFile
 
 ImageFile.MAXBLOCK = 1048576
@@ -39,6 +48,62 @@ ImageFile.MAXBLOCK = 1048576
 KYB_DB_URL = '/$App/db.sqlite'
 # Where to download KyBook 3's database file to
 KYB_DB_FILE = os.path.join(tempfile.gettempdir(), 'db.sqlite')
+# Where to keep local caches (can be changed with --cache-dir)
+CACHE_DIR = tempfile.gettempdir()
+# Cache of the MD5s of Calibre's book files (kept in CACHE_DIR)
+MD5_CACHE_FILE = 'KyBook3Sync_md5.sqlite'
+# File (in the cache dir) used to cache thumbnails of Calibre's covers
+THUMB_CACHE_FILE = 'KyBook3Sync_thumbs.sqlite'
+# File (in the cache dir) used to record the covers uploaded to KyBook 3
+COVER_LEDGER_FILE = 'KyBook3Sync_covers.sqlite'
+# Journal of the uploads done by unfinished syncs (kept in CACHE_DIR)
+JOURNAL_FILE = 'KyBook3Sync_journal.sqlite'
+# Journal entries older than this (in days) are discarded
+JOURNAL_MAX_AGE = 7
+# File (in the cache dir) used to record what was synced to each device, for
+# incremental syncs
+SYNC_STATE_FILE = 'KyBook3Sync_state.sqlite'
+# Where to keep compressed snapshots of KyBook 3's DB (can be changed with
+# --snapshot-dir), and the number of snapshots of each kind kept there
+SNAPSHOT_DIR = os.path.join(tempfile.gettempdir(), 'KyBook3Sync_snapshots')
+SNAPSHOT_KEEP = 5
+# gzip level used to compress snapshots (1 is fastest, 9 is smallest)
+SNAPSHOT_COMPRESSION = 6
+# Size of the chunks read when hashing book files (memory use is flat)
+HASH_CHUNK_SIZE = 1024 * 1024
+# Number of files hashed in parallel (can be changed with --hash-workers)
+HASH_WORKERS = os.cpu_count() or 1
+# Maximum bytes of files queued for hashing ahead of the current book
+HASH_MAX_INFLIGHT = 512 * 1024 * 1024
+# Size of the chunks sent when uploading files
+UPLOAD_CHUNK_SIZE = 256 * 1024
+# Size of the chunks written to disk when downloading files
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# Number of downloads (to download_dir) run in parallel (can be changed with
+# --download-workers)
+DOWNLOAD_WORKERS = 2
+# Maximum number of idle keep-alive connections to the content server
+HTTP_POOL_SIZE = 4
+# Seconds to wait on a socket to the content server before giving up
+HTTP_TIMEOUT = 30
+# Number of uploads run in parallel (can be changed with --upload-workers)
+UPLOAD_WORKERS = 2
+# Number of attempts for each upload, and the backoff between them (secs)
+UPLOAD_TRIES = 5
+BACKOFF_BASE = 1
+BACKOFF_MAX = 30
+# Seconds to wait for KyBook 3 to add uploaded files to its DB (can be
+# changed with --ready-timeout), and the longest gap between checks
+READY_TIMEOUT = 120
+READY_POLL_MAX = 10
+# While waiting, KyBook 3's DB is only downloaded again when its size changes,
+# or at least this often (secs), as new rows may fit in its free pages
+READY_REFRESH = 30
+# Number of covers shrunk to thumbnails in parallel (can be changed with
+# --thumb-workers)
+THUMB_WORKERS = os.cpu_count() or 1
+# Number of books whose metadata is written to KyBook 3's DB per transaction
+BATCH_SIZE = 500
 # Tables that have collation that needs removing
 COLLATION_TABLES = ['authors', 'publishers', 'subjects', 'sequences']
 # Lookup tables used by KyBook 3. Currently same as above.
@@ -53,6 +118,18 @@ EBOOK_SCHEMES = {'isbn': '10', 'amazon': '15', 'asin': '15', 'oclc': '12'}
 # ---------------------------------------------------------- #
 
 
+# One file of a book, as hashed for this sync
+ManifestEntry = namedtuple('ManifestEntry', 'bid file_row b_file md5 size')
+# A fully read response from the content server
+Response = namedtuple('Response', 'status reason data')
+# What a transfer is for: the Calibre book, and the journal kind & item
+TransferKey = namedtuple('TransferKey', 'bid title kind item')
+# Which of Calibre's books to sync from the command line (None for any).
+# download_dir is still compared against every book in Calibre
+BookFilter = namedtuple('BookFilter', 'ids tags series formats '
+                        'modified_after modified_before',
+                        defaults=(None, ) * 6)
+
 LOG = logging.getLogger(__name__)
 LOG_LEVELS = {'critical': logging.CRITICAL,
               'error': logging.ERROR,
@@ -61,6 +138,73 @@ LOG_LEVELS = {'critical': logging.CRITICAL,
               'debug': logging.DEBUG}
 
 
+def file_md5(path, chunk_size=HASH_CHUNK_SIZE):
+    """ Get the MD5 of a file without reading it all into memory.
+        The file is read in fixed size chunks into a single reused buffer, so
+        memory use doesn't depend on the size of the file. """
+    md5 = hashlib.md5()
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as fyl:
+        while True:
+            size = fyl.readinto(buf)
+            if not size:
+                break
+            md5.update(view[:size])
+    return md5.hexdigest()
+
+
+def make_thumbnail(cover_file):
+    """ Make a thumbnail of a book's cover that fits KyBook's required
+        dimensions (74 x 105).
+        JPEGs are decoded in draft mode, i.e., already scaled down by the
+        decoder, rather than at full resolution.
+        Returns the JPEG bytes and the aspect ratio of the thumbnail. """
+    with open(cover_file, 'rb') as fyl:
+        jpg_data = fyl.read()
+    image = Image.open(BytesIO(jpg_data))
+    image.draft('RGB', (THUMB_WIDTH, THUMB_HEIGHT))
+    if (image.size[0] > THUMB_WIDTH) or (image.size[1] > THUMB_HEIGHT):
+        reduced_image = KyBookDB._reduce_image_size(image, THUMB_HEIGHT,
+                                                    THUMB_WIDTH)
+    else:
+        reduced_image = image
+    aspectratio = reduced_image.size[1] / (reduced_image.size[0] * 1.0)
+    output = BytesIO()
+    reduced_image.save(output, format='jpeg', optimize=True, quality=85)
+    return output.getvalue(), aspectratio
+
+
+def _thumbnail_or_none(cover_file):
+    """ make_thumbnail() for a pool worker: None if the cover can't be read,
+        so one bad cover doesn't stop the rest. """
+    try:
+        return make_thumbnail(cover_file)
+    except (IOError, UnboundLocalError):
+        return None
+
+
+def file_signature(b_files):
+    """ Get a signature of the set of files a book has, which changes when
+        a file (format) is added or removed. """
+    names = sorted(os.path.basename(b_file) for b_file in b_files)
+    return hashlib.md5('\n'.join(names).encode('utf-8')).hexdigest()
+
+
+def timed_file_md5(path, chunk_size=HASH_CHUNK_SIZE):
+    """ Get the MD5 of a file and the time taken to hash it. """
+    start = time.time()
+    md5 = file_md5(path, chunk_size)
+    return md5, time.time() - start
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, maximum=BACKOFF_MAX):
+    """ Seconds to wait before retrying after attempt (0, 1, 2, ...).
+        Exponential backoff with full jitter, so parallel workers that fail
+        together don't all retry together. """
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
 class Table(object):
     """ Representation of a database table.
 
@@ -125,6 +269,15 @@ class Table(object):
 class Database(object):
     """ Implements a driver for an sqlite3 database. """
 
+    # Set False in subclasses that are shared between threads (with a lock)
+    check_same_thread = True
+    # True while commit() is deferred by batch()
+    _batching = False
+    # Writes since the last commit by commit_every()
+    _uncommitted = 0
+    # Set True (e.g., with --sql-trace) to log every statement SQLite runs
+    trace_sql = False
+
     def __init__(self, path):
         self.open(path)
 
@@ -151,41 +304,74 @@ class Database(object):
 
     def open(self, path):
         """ Open a connection to a sqlite database file """
-        self._conn = sqlite3.connect(path)
-        # self._conn.set_trace_callback(print)  # So we can log actual SQL
+        self._conn = sqlite3.connect(
+            path, check_same_thread=self.check_same_thread)
+        if self.trace_sql:
+            # So we can log actual SQL
+            self._conn.set_trace_callback(self._trace)
         self._conn.row_factory = sqlite3.Row  # So we can index by col name
         self._cursor = self._conn.cursor()
 
     def execute(self, sql, params=None, log_result=False):
-        """ Execute an SQL query. """
-        saved_sql = sql
-        LOG.debug(saved_sql)
-        # if params and len(params) > 0:
-        if params:
-            temp_sql = "SELECT " + ", ".join(["quote(?)" for param in params])
-            self.cursor.execute(temp_sql, params)
-            quoted_values = self.cursor.fetchone()
-            for quoted_value in quoted_values:
-                saved_sql = re.sub(r'(VALUES\(|, | = | LIKE )\?',
-                                   r'\g<1>' + str(quoted_value),
-                                   saved_sql, 1)
-        LOG.debug(saved_sql)
+        """ Execute an SQL query.
+            Nothing is formatted for the log unless DEBUG is enabled. To log
+            the SQL actually run, with values filled in, use trace_sql. """
+        debug = LOG.isEnabledFor(logging.DEBUG)
+        if debug and not self.trace_sql:
+            LOG.debug('%s %s', sql, params or '')
         self.cursor.execute(sql, params or ())
-        if log_result:
+        if log_result and debug:
             LOG.debug('Row count: %s', self.cursor.rowcount)
             if self.cursor.rowcount == 1:
                 LOG.debug('OK')
             elif not self.cursor.rowcount == -1:
                 LOG.debug('Failed!')
 
+    @staticmethod
+    def _trace(statement):
+        """ Log a statement run by SQLite (see trace_sql). """
+        LOG.debug('SQL: %s', statement)
+
     def executemany(self, sql, params=None):
         """ Executemany an SQL query. """
         self.cursor.executemany(sql, params or [])
 
     def commit(self):
-        """ Commit changes to the database. """
+        """ Commit changes to the database.
+            Does nothing inside batch(), which commits for itself. """
+        if self._batching:
+            return
+        self.connection.commit()
+
+    @contextmanager
+    def batch(self):
+        """ Run everything in the with block as one transaction.
+            Use checkpoint() to commit in chunks. If anything fails, the
+            changes since the last checkpoint are rolled back. """
+        self._batching = True
+        try:
+            yield self
+        except Exception:
+            LOG.error('Rolling back changes to the database')
+            self.connection.rollback()
+            raise
+        else:
+            self.checkpoint()
+        finally:
+            self._batching = False
+
+    def checkpoint(self):
+        """ Commit the changes made so far, even inside batch(). """
         self.connection.commit()
 
+    def commit_every(self, count=BATCH_SIZE):
+        """ Commit once every count calls, so that many small writes don't
+            each cost a sync to disk. The rest are committed by close(). """
+        self._uncommitted += 1
+        if self._uncommitted >= count:
+            self._uncommitted = 0
+            self.commit()
+
     def query(self, sql, params=None):
         """ Run an SQL query. """
         self.execute(sql, params or (), log_result=True)
@@ -202,10 +388,10 @@ class Database(object):
         return all_rows
 
     def dump(self, filename):
-        """ Emulate sqlite3 .dump command. """
-        with open(filename, 'w') as fyl:
+        """ Emulate sqlite3 .dump command. Slow, so only for debugging. """
+        with open(filename, 'w', encoding='utf-8') as fyl:
             for line in self.connection.iterdump():
-                fyl.write('%s\n' % line.encode('utf-8'))
+                fyl.write('%s\n' % line)
 
     def close(self):
         """ Close the connection """
@@ -219,20 +405,34 @@ class Database(object):
 class CalibreDB(Database):
     """ Implements a driver for Calibre's sqlite database."""
 
-    def __init__(self, db_path, cal_data):
+    def __init__(self, db_path, cal_data, md5_cache=None,
+                 hash_chunk_size=HASH_CHUNK_SIZE, book_filter=None):
         super(CalibreDB, self).__init__(db_path)
         LOG.debug('Opening: %s', db_path)
+        # Only used without cal_data, i.e., from the command line
+        self._filter = book_filter or BookFilter()
         self._lib_path = os.path.dirname(db_path)
         self._cal_data = cal_data
+        # cal_data keyed by book id, built by get_metadata()
+        self._cal_index = {}
+        self._md5_cache = md5_cache
+        self._hash_chunk_size = hash_chunk_size
 
     @property
     def cal_data(self):
         """ Allow access to self._cal_data """
         return self._cal_data
 
-    def get_metadata(self):
+    def get_datum(self, b_id):
+        """ Get a book's entry in cal_data, by its id. """
+        return self._cal_index.get(b_id)
+
+    def get_metadata(self, sync_state=None):
         """ Select the metadata items from Calibre's DB that we need for
-            KyBook 3's DB """
+            KyBook 3's DB
+            If sync_state is given, only books that have changed since they
+            were last synced are selected. Without cal_data, the selection is
+            also narrowed by the book filter (see _filter_sql()). """
         # If we were called from the plugin we already have the data
         if self._cal_data:
             for cal_datum in self._cal_data:
@@ -251,6 +451,13 @@ class CalibreDB(Database):
                     cal_datum['language'] = ''
                 # publisher is a string
                 cal_datum['publishers'] = [cal_datum['publisher']]
+            self._cal_index = dict((cal_datum['id'], cal_datum)
+                                   for cal_datum in self._cal_data)
+            if sync_state:
+                return [cal_datum for cal_datum in self._cal_data
+                        if sync_state.changed(
+                            cal_datum['id'], cal_datum['last_modified'],
+                            file_signature(cal_datum['paths']))]
             return self._cal_data
         # SQL code to select the data from Calibre that needs to go to
         # KyBook 3.
@@ -267,43 +474,288 @@ class CalibreDB(Database):
     WHERE book = books.id
 ) AS comments,
 path,
-last_modified
-FROM books;""")
-        return self.query(cal_metadata_sql)
+last_modified,
+series_index
+FROM books{0};""")
+        conditions, params = self._filter_sql()
+        since = sync_state.last_sync() if sync_state else None
+        if since:
+            # Books modified since the last sync, or whose files changed
+            changed_ids = sync_state.changed_files(self.get_file_signatures())
+            LOG.info('Selecting books modified since %s, or with %d changed '
+                     'files', since, len(changed_ids))
+            condition = 'last_modified > ?'
+            if changed_ids:
+                condition += ' OR id IN ({0})'.format(
+                    ', '.join(str(int(b_id)) for b_id in changed_ids))
+            conditions.append(condition)
+            params.append(since)
+        where = ''
+        if conditions:
+            where = ' WHERE ' + ' AND '.join('(%s)' % condition
+                                             for condition in conditions)
+        return self._get_records(self.query(cal_metadata_sql.format(where),
+                                            params))
+
+    def _filter_sql(self):
+        """ Build the conditions on Calibre's books table, and their params,
+            for the book filter. """
+        # SQL code to select the books linked to named entries
+        # E.g., 0 = tags; 1 = tag; 2 = '?, ?'
+        sel_linked_sql = ("""id IN (SELECT l.book FROM books_{0}_link AS l
+    JOIN {0} AS t ON t.id = l.{1}
+    WHERE t.name IN ({2}))""")
+        book_filter = self._filter
+        conditions = []
+        params = []
+        if book_filter.ids:
+            conditions.append('id IN ({0})'.format(
+                ', '.join(str(int(b_id)) for b_id in book_filter.ids)))
+        for names, table, col in ((book_filter.tags, 'tags', 'tag'),
+                                  (book_filter.series, 'series', 'series')):
+            if names:
+                conditions.append(sel_linked_sql.format(
+                    table, col, ', '.join('?' * len(names))))
+                params.extend(names)
+        if book_filter.formats:
+            format_sql, format_params = self._format_sql()
+            conditions.append('id IN (SELECT book FROM data WHERE {0})'.format(
+                format_sql))
+            params.extend(format_params)
+        if book_filter.modified_after:
+            conditions.append('last_modified >= ?')
+            params.append(book_filter.modified_after)
+        if book_filter.modified_before:
+            conditions.append('last_modified < ?')
+            params.append(book_filter.modified_before)
+        return conditions, params
+
+    def _format_sql(self):
+        """ Build the condition on Calibre's data table, and its params, for
+            the formats in the book filter. """
+        formats = [fmt.upper() for fmt in self._filter.formats or []]
+        if not formats:
+            return '1', []
+        return 'format IN ({0})'.format(', '.join('?' * len(formats))), formats
+
+    def _get_records(self, rows):
+        """ Build a record (a dict, like the plugin's cal_data) for each of
+            the books selected from Calibre's DB.
+            Each relation (authors, tags, etc.) is pulled for all the books at
+            once, in one query, rather than per book. The selected ids are
+            put in a temp table to join against. """
+        # SQL code to select a lookup table's entries for the selected books
+        # E.g., 0 = tags; 1 = tag; 2 = extra cols
+        sel_links_sql = ("""SELECT l.book, t.name{2}
+FROM books_{0}_link AS l
+JOIN {0} AS t ON t.id = l.{1}
+WHERE l.book IN (SELECT book FROM temp.sync_selection)
+ORDER BY l.id;""")
+        sel_identifiers_sql = ("""SELECT book, type, val FROM identifiers
+WHERE book IN (SELECT book FROM temp.sync_selection)
+ORDER BY id;""")
+        sel_ratings_sql = ("""SELECT l.book, t.rating
+FROM books_ratings_link AS l
+JOIN ratings AS t ON t.id = l.rating
+WHERE l.book IN (SELECT book FROM temp.sync_selection);""")
+        sel_files_sql = ("""SELECT book, name as filename, LOWER(format) as ext
+FROM data
+WHERE book IN (SELECT book FROM temp.sync_selection) AND {0}
+ORDER BY id;""")
+        records = []
+        for row in rows:
+            record = dict(zip(row.keys(), row))
+            for lookup_table in LOOKUP_TABLES:
+                record[lookup_table] = []
+            record['rating'] = None
+            record['files'] = []
+            records.append(record)
+        self._cal_index = dict((record['id'], record) for record in records)
+        self.execute("""CREATE TEMP TABLE IF NOT EXISTS sync_selection
+(book INTEGER NOT NULL PRIMARY KEY);""")
+        self.execute("""DELETE FROM temp.sync_selection;""")
+        self.executemany("""INSERT INTO temp.sync_selection (book) VALUES(?);""",
+                         [(record['id'], ) for record in records])
+        # Filling the temp table opened a transaction; don't hold a lock on
+        # Calibre's library for the rest of the sync
+        self.commit()
+        for lookup_table in LOOKUP_TABLES:
+            tbl = Table(lookup_table)
+            if tbl.name == 'ebookids':
+                sql = sel_identifiers_sql
+            else:
+                sql = sel_links_sql.format(
+                    tbl.calname, tbl.calmain,
+                    ', t.sort' if tbl.name == 'authors' else '')
+            for row in self.query(sql):
+                # authors are (name, sort); ebookids are (type, value)
+                value = tuple(row)[1:] if len(row) > 2 else row[1]
+                self._cal_index[row[0]][tbl.name].append(value)
+        for row in self.query(sel_ratings_sql):
+            self._cal_index[row['book']]['rating'] = row['rating']
+        format_sql, format_params = self._format_sql()
+        for row in self.query(sel_files_sql.format(format_sql), format_params):
+            self._cal_index[row['book']]['files'].append(
+                {'filename': row['filename'], 'ext': row['ext']})
+        return records
+
+    def get_file_signatures(self):
+        """ Get the file_signature() of every book in Calibre's DB, as a dict
+            of book id: signature, in one query. Only files in the formats of
+            the book filter count. """
+        data_sql = ("""SELECT book, name, LOWER(format) as ext FROM data
+WHERE {0};""")
+        format_sql, format_params = self._format_sql()
+        names = {}
+        for row in self.query(data_sql.format(format_sql), format_params):
+            names.setdefault(row['book'], []).append(
+                row['name'] + '.' + row['ext'])
+        return dict((b_id, file_signature(b_files))
+                    for b_id, b_files in names.items())
+
+    def get_library_md5s(self, known=None, workers=HASH_WORKERS):
+        """ Get the MD5s of the files of every book in Calibre's library,
+            whatever the selection and book filter, to tell which of KyBook
+            3's books Calibre already has.
+            known is a dict of file: MD5 (e.g., from the manifest) that
+            needn't be looked up again. Other files come from the MD5 cache,
+            or are hashed by a pool of workers. """
+        # SQL code to select every file in Calibre's library
+        library_files_sql = ("""SELECT b.path, d.name as filename,
+    LOWER(d.format) as ext
+FROM data AS d
+JOIN books AS b ON b.id = d.book;""")
+        known = known or {}
+        md5s = set(known.values())
+        to_hash = []
+        for row in self.query(library_files_sql):
+            b_file = os.path.join(self._lib_path, row['path'],
+                                  row['filename'] + '.' + row['ext'])
+            if b_file in known or not os.path.isfile(b_file):
+                continue
+            md5 = None
+            if self._md5_cache:
+                md5 = self._md5_cache.lookup(b_file)
+            if md5:
+                md5s.add(md5)
+            else:
+                to_hash.append(b_file)
+        if to_hash:
+            LOG.info('Hashing %d more files in Calibre\'s library with %d '
+                     'workers', len(to_hash), workers)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                hashes = executor.map(timed_file_md5, to_hash,
+                                      [self._hash_chunk_size] * len(to_hash))
+                for b_file, (md5, hash_time) in zip(to_hash, hashes):
+                    if self._md5_cache:
+                        self._md5_cache.store(b_file, md5, hash_time)
+                    md5s.add(md5)
+        return md5s
 
     def get_books_files(self, b_id):
         """ Get the files associated with a book. """
-        if self._cal_data:
-            for cal_datum in self._cal_data:
-                if cal_datum['id'] == b_id:
-                    return cal_datum['paths']
+        cal_datum = self.get_datum(b_id)
+        if cal_datum:
+            if self._cal_data:
+                return cal_datum['paths']
+            return cal_datum['files']
         # SQL code to select the filename's associated with a book.
         books_files_sql = ("""SELECT name as filename, LOWER(format) as ext
 FROM data
-WHERE book = ?;""")
-        return self.query(books_files_sql, (b_id,))
+WHERE book = ? AND {0};""")
+        format_sql, format_params = self._format_sql()
+        return self.query(books_files_sql.format(format_sql),
+                          [b_id] + format_params)
 
     def update(self):
         """ Update Calibre's DB with metadata from KyBook 3's DB. """
         # TODO: Consider adding this.
         pass
 
-    def get_md5(self, path, row):
-        """ Get the md5 hash of a book's file on disk.
-            MD5 is used by KyBook and makes sure we are talking about the same
-            file and, consequently, book."""
-        md5 = ''
-        b_file = self.path_from_row(path, row)
-        md5 = hashlib.md5(open(b_file, 'rb').read()).hexdigest()
-        LOG.debug('MD5 for %s: %s', b_file, md5)
-        return md5
-
-    def send_book_file_to_cs(self, c_s, path, row):
-        """ Send a book's file to KyBook 3's content server."""
+    def get_manifest(self, conn=None, workers=HASH_WORKERS,
+                     max_inflight=HASH_MAX_INFLIGHT, sync_state=None):
+        """ Hash every file of every book once for this sync.
+            Returns a list of (metadata row, [ManifestEntry, ...]) which is
+            then shared by the file sync, the metadata sync and the
+            comparison with KyBook 3's files.
+
+            Files not in the MD5 cache are hashed by a pool of workers, but
+            books are returned (and progress reported) in their original
+            order. With sync_state, only changed books are included (see
+            get_metadata()). """
+        books = []
+        for cal_datum in self.get_metadata(sync_state):
+            cal_path = cal_datum['path']
+            files = []
+            for file_row in self.get_books_files(cal_datum['id']):
+                b_file = self.path_from_row(cal_path, file_row)
+                files.append((file_row, b_file, os.path.getsize(b_file)))
+            books.append((cal_datum, files))
+        manifest = []
+        total = len(books)
+        LOG.info('Hashing the files of %d books with %d workers', total,
+                 workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            hashed_books = self._hash_books(books, executor, max_inflight)
+            for count, book in enumerate(hashed_books, 1):
+                manifest.append(book)
+                if conn:
+                    conn.send({'pass': 'Hashing', 'count': count,
+                               'total': total})
+        return manifest
+
+    def _hash_books(self, books, executor, max_inflight):
+        """ Yield (metadata row, [ManifestEntry, ...]) in book order while
+            files are hashed in the background.
+            Submission stops once max_inflight bytes of files are waiting to
+            be hashed, so a slow book at the front can't queue the whole
+            library behind it. """
+        pending = deque()
+        inflight = 0
+
+        def finish_book():
+            nonlocal inflight
+            cal_datum, items = pending.popleft()
+            entries = []
+            for file_row, b_file, size, md5 in items:
+                if not isinstance(md5, str):
+                    md5, hash_time = md5.result()
+                    inflight -= size
+                    if self._md5_cache:
+                        self._md5_cache.store(b_file, md5, hash_time)
+                LOG.debug('MD5 for %s: %s', b_file, md5)
+                entries.append(ManifestEntry(cal_datum['id'], file_row,
+                                             b_file, md5, size))
+            return cal_datum, entries
+
+        for cal_datum, files in books:
+            items = []
+            for file_row, b_file, size in files:
+                md5 = None
+                if self._md5_cache:
+                    md5 = self._md5_cache.lookup(b_file)
+                if not md5:
+                    md5 = executor.submit(timed_file_md5, b_file,
+                                          self._hash_chunk_size)
+                    inflight += size
+                items.append((file_row, b_file, size, md5))
+            pending.append((cal_datum, items))
+            while pending and inflight > max_inflight:
+                yield finish_book()
+        while pending:
+            yield finish_book()
+
+    def send_book_file_to_cs(self, c_s, path, row, scheduler=None, key=None):
+        """ Send a book's file to KyBook 3's content server.
+            If a scheduler is given the upload is queued on it under key. """
         b_file = self.path_from_row(path, row)
         # Upload to /Books/, same name, don't delete existing file.
-        c_s.upload_file(b_file, '/Books/', remote_file=None,
-                        del_existing=False)
+        if scheduler:
+            scheduler.submit(key, c_s.upload_file, b_file, '/Books/',
+                             remote_file=None, del_existing=False)
+            return None
+        return c_s.upload_file(b_file, '/Books/', remote_file=None,
+                               del_existing=False)
 
     def path_from_row(self, path, row):
         """ Utility method to build a path from a row of data. """
@@ -325,18 +777,484 @@ WHERE book = ?;""")
         return (stamp - offset).total_seconds()
 
 
+class Md5Cache(Database):
+    """ Implements a local cache of the MD5s of Calibre's book files.
+
+        Hashing large books is slow, so each MD5 is stored with the file's
+        path, size and modification time. If any of these change the file is
+        hashed again. """
+
+    def __init__(self, db_path):
+        super(Md5Cache, self).__init__(db_path)
+        LOG.debug('Opening: %s', db_path)
+        self.hits = 0
+        self.misses = 0
+        self.hash_time = 0.0
+        self._stats = {}
+        create_md5s_sql = ("""CREATE TABLE IF NOT EXISTS md5s
+(
+    path TEXT NOT NULL PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    md5 TEXT NOT NULL
+);""")
+        self.execute(create_md5s_sql)
+        self.commit()
+
+    def lookup(self, b_file):
+        """ Return the cached MD5 of a file, or None if it isn't cached or
+            the file has changed since it was cached. """
+        sel_md5_sql = ("""SELECT size, mtime_ns, md5 FROM md5s
+WHERE path = ?;""")
+        b_file = os.path.abspath(b_file)
+        stat = os.stat(b_file)
+        # Remember the stat so store() records the file as it was hashed
+        self._stats[b_file] = (stat.st_size, stat.st_mtime_ns)
+        self.execute(sel_md5_sql, (b_file,))
+        row = self.fetchone()
+        if row and (row['size'], row['mtime_ns']) == self._stats[b_file]:
+            self.hits += 1
+            return row['md5']
+        self.misses += 1
+        return None
+
+    def store(self, b_file, md5, hash_time=0.0):
+        """ Add (or replace) the MD5 of a file in the cache. """
+        ins_md5_sql = ("""INSERT OR REPLACE INTO md5s (path, size, mtime_ns, md5)
+VALUES(?, ?, ?, ?);""")
+        b_file = os.path.abspath(b_file)
+        size, mtime_ns = self._stats.pop(b_file, (None, None))
+        if size is None:
+            stat = os.stat(b_file)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        self.hash_time += hash_time
+        self.execute(ins_md5_sql, (b_file, size, mtime_ns, md5))
+        self.commit_every()
+
+    def prune(self):
+        """ Remove the cached MD5s of files that no longer exist. """
+        del_md5_sql = ("""DELETE FROM md5s WHERE path = ?;""")
+        gone = [(row['path'],) for row in self.query('SELECT path FROM md5s;')
+                if not os.path.exists(row['path'])]
+        LOG.debug('Pruning %d MD5s from the cache', len(gone))
+        self.executemany(del_md5_sql, gone)
+        self.commit()
+
+    def log_stats(self):
+        """ Report how useful the cache was. """
+        LOG.info('MD5 cache: %d hits, %d misses (%.1fs spent hashing)',
+                 self.hits, self.misses, self.hash_time)
+
+
+class ThumbCache(Database):
+    """ Implements a local cache of thumbnails of Calibre's covers.
+
+        Each thumbnail is stored with the cover's path, size and
+        modification time, so a cover is only shrunk again when it changes.
+    """
+
+    def __init__(self, db_path):
+        super(ThumbCache, self).__init__(db_path)
+        LOG.debug('Opening: %s', db_path)
+        self.hits = 0
+        self.misses = 0
+        create_thumbs_sql = ("""CREATE TABLE IF NOT EXISTS thumbs
+(
+    path TEXT NOT NULL PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    thumbnail BLOB NOT NULL,
+    aspectratio REAL NOT NULL
+);""")
+        self.execute(create_thumbs_sql)
+        self.commit()
+
+    def lookup(self, cover_file):
+        """ Return the cached (thumbnail, aspectratio) of a cover, or None if
+            it isn't cached or the cover has changed since it was cached. """
+        sel_thumb_sql = ("""SELECT size, mtime_ns, thumbnail, aspectratio
+FROM thumbs WHERE path = ?;""")
+        cover_file = os.path.abspath(cover_file)
+        stat = os.stat(cover_file)
+        self.execute(sel_thumb_sql, (cover_file,))
+        row = self.fetchone()
+        if row and (row['size'], row['mtime_ns']) == (stat.st_size,
+                                                      stat.st_mtime_ns):
+            self.hits += 1
+            return row['thumbnail'], row['aspectratio']
+        self.misses += 1
+        return None
+
+    def store(self, cover_file, thumbnail, aspectratio):
+        """ Add (or replace) the thumbnail of a cover in the cache. """
+        ins_thumb_sql = ("""INSERT OR REPLACE INTO thumbs
+(path, size, mtime_ns, thumbnail, aspectratio) VALUES(?, ?, ?, ?, ?);""")
+        cover_file = os.path.abspath(cover_file)
+        stat = os.stat(cover_file)
+        self.execute(ins_thumb_sql, (cover_file, stat.st_size,
+                                     stat.st_mtime_ns,
+                                     sqlite3.Binary(thumbnail), aspectratio))
+        self.commit_every()
+
+    def prune(self):
+        """ Remove the cached thumbnails of covers that no longer exist. """
+        del_thumb_sql = ("""DELETE FROM thumbs WHERE path = ?;""")
+        gone = [(row['path'],) for row in self.query('SELECT path FROM thumbs;')
+                if not os.path.exists(row['path'])]
+        LOG.debug('Pruning %d thumbnails from the cache', len(gone))
+        self.executemany(del_thumb_sql, gone)
+        self.commit()
+
+    def log_stats(self):
+        """ Report how useful the cache was. """
+        LOG.info('Thumbnail cache: %d hits, %d misses',
+                 self.hits, self.misses)
+
+
+class CoverLedger(Database):
+    """ Implements a local ledger of the covers uploaded to KyBook 3.
+
+        For each device (content server) and KyBook 3 book, the MD5s of the
+        book's file and of the cover last uploaded for it are stored, so
+        covers that haven't changed aren't uploaded again. Uploads record
+        themselves from worker threads, hence the lock. """
+
+    check_same_thread = False
+    # HTTP requests saved by skipping a cover: the delete and the upload
+    REQUESTS_PER_COVER = 2
+
+    def __init__(self, db_path, device, md5_cache=None):
+        super(CoverLedger, self).__init__(db_path)
+        LOG.debug('Opening: %s', db_path)
+        self._device = device
+        self._md5_cache = md5_cache
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.skipped = 0
+        self.bytes_saved = 0
+        create_covers_sql = ("""CREATE TABLE IF NOT EXISTS covers
+(
+    device TEXT NOT NULL,
+    bid INTEGER NOT NULL,
+    md5 TEXT NOT NULL,
+    cover_md5 TEXT NOT NULL,
+    PRIMARY KEY (device, bid)
+);""")
+        sel_covers_sql = ("""SELECT bid, md5, cover_md5 FROM covers
+WHERE device = ?;""")
+        self.execute(create_covers_sql)
+        self.commit()
+        self._covers = dict((row['bid'], (row['md5'], row['cover_md5']))
+                            for row in self.query(sel_covers_sql, (device,)))
+
+    def _cover_md5(self, c_file):
+        """ Get the MD5 of a cover, from the MD5 cache if possible. """
+        cover_md5 = None
+        if self._md5_cache:
+            cover_md5 = self._md5_cache.lookup(c_file)
+        if not cover_md5:
+            cover_md5, hash_time = timed_file_md5(c_file)
+            if self._md5_cache:
+                self._md5_cache.store(c_file, cover_md5, hash_time)
+        return cover_md5
+
+    def unchanged(self, bid, md5, c_file):
+        """ Check whether a cover is the one last uploaded for a book.
+            If not, it's remembered for record(), once it's uploaded. """
+        cover = (md5, self._cover_md5(c_file))
+        with self._lock:
+            if self._covers.get(bid) == cover:
+                self.skipped += 1
+                self.bytes_saved += os.path.getsize(c_file)
+                return True
+            self._pending[bid] = cover
+        return False
+
+    def record(self, bid):
+        """ Record that the cover checked by unchanged() was uploaded. """
+        ins_cover_sql = ("""INSERT OR REPLACE INTO covers
+(device, bid, md5, cover_md5) VALUES(?, ?, ?, ?);""")
+        with self._lock:
+            cover = self._pending.pop(bid, None)
+            if not cover:
+                return
+            self._covers[bid] = cover
+            self.execute(ins_cover_sql, (self._device, bid) + cover)
+            self.commit()
+
+    def log_stats(self):
+        """ Report what skipping unchanged covers saved. """
+        LOG.info('Cover ledger: %d unchanged covers skipped, saving %d '
+                 'requests and %.1f MB', self.skipped,
+                 self.skipped * self.REQUESTS_PER_COVER,
+                 self.bytes_saved / (1024.0 * 1024.0))
+
+
+class SyncJournal(Database):
+    """ Implements a local journal of the work done by a sync.
+
+        Each sync is a session, identified by the content server, library
+        and books being synced. Completed file uploads, cover uploads and
+        metadata writes are recorded as they happen, so if a sync fails a
+        rerun of the same session can skip them. The session is cleared once
+        a sync finishes without failures. Uploads record themselves from
+        worker threads, hence the lock. """
+
+    check_same_thread = False
+
+    def __init__(self, db_path, session):
+        super(SyncJournal, self).__init__(db_path)
+        LOG.debug('Opening: %s', db_path)
+        self._session = session
+        self._lock = threading.Lock()
+        self._staged = []
+        create_journal_sql = ("""CREATE TABLE IF NOT EXISTS journal
+(
+    session TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    item TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    PRIMARY KEY (session, kind, item)
+);""")
+        del_old_sql = ("""DELETE FROM journal WHERE timestamp < ?;""")
+        sel_session_sql = ("""SELECT kind, item FROM journal
+WHERE session = ?;""")
+        self.execute(create_journal_sql)
+        self.execute(del_old_sql, (time.time() - JOURNAL_MAX_AGE * 86400,))
+        self.commit()
+        self._done = set((row['kind'], row['item'])
+                         for row in self.query(sel_session_sql, (session,)))
+        if self._done:
+            LOG.info('Resuming an unfinished sync: %d items already done',
+                     len(self._done))
+
+    @staticmethod
+    def session_id(content_server, library_path, book_ids):
+        """ Identify a sync by where it goes, where from and what it syncs.
+        """
+        key = '%s|%s|%s' % (content_server, library_path,
+                            ','.join(str(b_id) for b_id in sorted(book_ids)))
+        return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    def done(self, kind, item):
+        """ Check whether an item was completed by an earlier run. """
+        with self._lock:
+            return (kind, str(item)) in self._done
+
+    def record(self, kind, item):
+        """ Record that an item has been completed. """
+        ins_journal_sql = ("""INSERT OR REPLACE INTO journal
+(session, kind, item, timestamp) VALUES(?, ?, ?, ?);""")
+        with self._lock:
+            self._done.add((kind, str(item)))
+            self.execute(ins_journal_sql,
+                         (self._session, kind, str(item), time.time()))
+            self.commit()
+
+    def stage(self, kind, item):
+        """ Note an item that will be complete once record_staged() is
+            called, e.g., metadata written to the local copy of the DB. """
+        self._staged.append((kind, item))
+
+    def record_staged(self):
+        """ Record all the staged items as completed. """
+        for kind, item in self._staged:
+            self.record(kind, item)
+        self._staged = []
+
+    def finish(self):
+        """ Forget the session, once everything in it has succeeded. """
+        del_session_sql = ("""DELETE FROM journal WHERE session = ?;""")
+        with self._lock:
+            self._done = set()
+            self.execute(del_session_sql, (self._session,))
+            self.commit()
+
+
+class SyncState(Database):
+    """ Implements a local record of what was synced from a library to a
+        device (content server), for incremental syncs.
+
+        The start time of the last sync of the whole library is kept, along
+        with the last_modified and files (see file_signature()) of each book
+        as it was last synced successfully, and a fingerprint of the metadata
+        last written for each of KyBook 3's books. """
+
+    def __init__(self, db_path, library, device):
+        super(SyncState, self).__init__(db_path)
+        LOG.debug('Opening: %s', db_path)
+        self._key = (library, device)
+        create_syncs_sql = ("""CREATE TABLE IF NOT EXISTS syncs
+(
+    library TEXT NOT NULL,
+    device TEXT NOT NULL,
+    started TEXT NOT NULL,
+    PRIMARY KEY (library, device)
+);""")
+        create_books_sql = ("""CREATE TABLE IF NOT EXISTS books
+(
+    library TEXT NOT NULL,
+    device TEXT NOT NULL,
+    book INTEGER NOT NULL,
+    last_modified TEXT NOT NULL,
+    signature TEXT NOT NULL,
+    PRIMARY KEY (library, device, book)
+);""")
+        create_fingerprints_sql = ("""CREATE TABLE IF NOT EXISTS fingerprints
+(
+    library TEXT NOT NULL,
+    device TEXT NOT NULL,
+    bid INTEGER NOT NULL,
+    fingerprint TEXT NOT NULL,
+    PRIMARY KEY (library, device, bid)
+);""")
+        sel_books_sql = ("""SELECT book, last_modified, signature FROM books
+WHERE library = ? AND device = ?;""")
+        sel_fingerprints_sql = ("""SELECT bid, fingerprint FROM fingerprints
+WHERE library = ? AND device = ?;""")
+        self.execute(create_syncs_sql)
+        self.execute(create_books_sql)
+        self.execute(create_fingerprints_sql)
+        self.commit()
+        self._books = dict((row['book'],
+                            (row['last_modified'], row['signature']))
+                           for row in self.query(sel_books_sql, self._key))
+        self._fingerprints = dict(
+            (row['bid'], row['fingerprint'])
+            for row in self.query(sel_fingerprints_sql, self._key))
+        self._staged = {}
+
+    def last_sync(self):
+        """ Get the start time of the last successful sync of the whole
+            library, in the format of Calibre's last_modified, or None. """
+        sel_sync_sql = ("""SELECT started FROM syncs
+WHERE library = ? AND device = ?;""")
+        self.execute(sel_sync_sql, self._key)
+        row = self.fetchone()
+        return row['started'] if row else None
+
+    def changed(self, book, last_modified, signature):
+        """ Check whether a book has changed since it was last synced. """
+        return self._books.get(book) != (str(last_modified), signature)
+
+    def changed_files(self, signatures):
+        """ Get the ids of books whose files have changed since they were
+            last synced, from a dict of book id: file_signature(). """
+        return [book for book, signature in signatures.items()
+                if (self._books.get(book) or (None, None))[1] != signature]
+
+    def fingerprint(self, bid):
+        """ Get the fingerprint of the metadata last written for one of
+            KyBook 3's books, or None. """
+        return self._fingerprints.get(bid)
+
+    def stage_fingerprint(self, bid, fingerprint):
+        """ Note the fingerprint of metadata written to the local copy of
+            KyBook 3's DB; it's recorded by record(), once the DB is uploaded.
+        """
+        self._staged[bid] = fingerprint
+
+    def record(self, books, started=None, failed=()):
+        """ Record books, as (id, last_modified, signature), as synced, and
+            the staged fingerprints. If the whole library was synced, pass
+            the time the sync started. The ids of books that failed to sync
+            are forgotten, so they count as changed until they're synced. """
+        ins_book_sql = ("""INSERT OR REPLACE INTO books
+(library, device, book, last_modified, signature) VALUES(?, ?, ?, ?, ?);""")
+        ins_fingerprint_sql = ("""INSERT OR REPLACE INTO fingerprints
+(library, device, bid, fingerprint) VALUES(?, ?, ?, ?);""")
+        ins_sync_sql = ("""INSERT OR REPLACE INTO syncs
+(library, device, started) VALUES(?, ?, ?);""")
+        del_book_sql = ("""DELETE FROM books
+WHERE library = ? AND device = ? AND book = ?;""")
+        for book in failed:
+            self._books.pop(book, None)
+        self.executemany(del_book_sql, [self._key + (book, )
+                                        for book in failed])
+        rows = []
+        for book, last_modified, signature in books:
+            self._books[book] = (str(last_modified), signature)
+            rows.append(self._key + (book, str(last_modified), signature))
+        self.executemany(ins_book_sql, rows)
+        self._fingerprints.update(self._staged)
+        self.executemany(ins_fingerprint_sql,
+                         [self._key + item for item in self._staged.items()])
+        self._staged = {}
+        if started:
+            self.execute(ins_sync_sql, self._key + (started,))
+        self.commit()
+
+
 class KyBookDB(Database):
     """ Implements a driver for KyBook 3's sqlite database."""
 
-    def __init__(self, db_path, remove_html, cal_lib_path):
+    def __init__(self, db_path, remove_html, cal_lib_path, thumb_cache=None,
+                 sync_state=None):
         super(KyBookDB, self).__init__(db_path)
         LOG.debug('Opening: %s', db_path)
         self._remove_html = remove_html
         self._cal_lib_path = cal_lib_path
+        self._thumb_cache = thumb_cache
+        # Has the fingerprints of the metadata written by earlier syncs
+        self._sync_state = sync_state
+        # Thumbnails made during this sync, by cover file; all the files of
+        # a book share its cover
+        self._thumbs = {}
         LOG.debug('Collation tables: %s', COLLATION_TABLES)
         self._collation_tables = COLLATION_TABLES
         LOG.debug('Lookup tables: %s', LOOKUP_TABLES)
         self._lookup_tables = LOOKUP_TABLES
+        self._books = self._load_books()
+        # SQL for each lookup table, formatted once
+        self._lookup_sql = [self._format_lookup_sql(Table(lookup_table))
+                            for lookup_table in self._lookup_tables]
+        # Caches of the lookup tables, loaded by _lookup_cache()
+        self._lookups = {}
+        self._next_ids = {}
+        # Rows written by update() but queued for flush(): the bids of the
+        # books, the lookup table fills and links (by table) and the reviews
+        self._queued_bids = []
+        self._queued_links = OrderedDict()
+        self._queued_reviews = []
+
+    @staticmethod
+    def _format_lookup_sql(tbl):
+        """ Format the SQL used by _ins_book_to_link_tables() for a lookup
+            table.
+            Returns tbl, the SQL to upsert an entry with a given id into the
+            lookup table, and the SQL to link a book to an entry. """
+        # SQL code to insert into the lookup tables
+        # E.g., 0 = subjects; 1 = sid; 2 = subject; 3 = '?, ?'
+        fill_lookups_sql = ("""INSERT OR REPLACE INTO {0} ({1}, {2}, timestamp)
+    VALUES(?, {3});""")
+        # SQL code to insert into the link tables (books_subjects, etc.)
+        # E.g., 0 = subjects; 1 = sid; 2 = '?, ?'
+        ins_books_links_sql = ("""INSERT OR REPLACE INTO books_{0} (bid, {1})
+    VALUES({2});""")
+        kyb_sql_fil = fill_lookups_sql.format(tbl.name, tbl.xid, tbl.midcols,
+                                              tbl.questions)
+        if tbl.name == 'sequences':
+            kyb_sql_ins = ins_books_links_sql.format(
+                tbl.name, tbl.xid + ', seqnumber', '?, ?, ?')
+        else:
+            kyb_sql_ins = ins_books_links_sql.format(tbl.name, tbl.xid,
+                                                     '?, ?')
+        return tbl, kyb_sql_fil, kyb_sql_ins
+
+    def _load_books(self):
+        """ Load KyBook 3's books table in one scan, as a dict of
+            md5: (bid, timestamp), so a file's bid can be looked up without
+            going back to the DB. """
+        sel_books_sql = ("""SELECT md5, bid, timestamp FROM books;""")
+        books = dict((row['md5'], (row['bid'], row['timestamp']))
+                     for row in self.query(sel_books_sql))
+        LOG.debug('%d books in KyBook 3\'s DB', len(books))
+        return books
+
+    def bid(self, md5):
+        """ Get the bid of a book given its file's MD5, or None. """
+        book = self._books.get(md5)
+        return book[0] if book else None
 
     def set_collation(self, on_or_off):
         """ Set the Collation procedure on or off.
@@ -371,7 +1289,11 @@ SET SQL = 'CREATE TABLE {0}
 
     def update(self, cal_db, row, md5):
         """ Separate out the columns from Calibre's metadata and use them to
-            update KyBook 3's DB. """
+            update KyBook 3's DB.
+            Nothing is written if the fingerprint of the rows is the same as
+            when they were last written to KyBook 3, unless the book's row in
+            KyBook 3's DB has changed since (e.g., the DB was restored or
+            rebuilt). Returns whether the metadata was written. """
         # SQL code to update KyBook 3's DB with metadata from Calibre.
         update_metadata_sql = ("""UPDATE metadata
 SET title = ?,
@@ -381,11 +1303,12 @@ SET title = ?,
     thumbnail = ?,
     aspectratio = ?,
     coverhash = ?
-WHERE bid = (
-    SELECT bid
-    FROM books
-    WHERE md5 = ?);""")
+WHERE bid = ?;""")
         b_id = row['id']
+        kyb_bid = self.bid(md5)
+        if kyb_bid is None:
+            LOG.info('Book not in KyBook 3\'s database; not updating.')
+            return False
         title = row['title']
         published = row.get('pubdate', '')
         language = row.get('language', '')
@@ -406,22 +1329,92 @@ WHERE bid = (
         # each file.
         # path = row['path']
         thumbnail, aspectratio = self._get_thumb(row)
-        # WATCH OUT! md5 needs to be the last entry.
         update_data = (title, published, language, annotation, thumbnail,
-                       aspectratio, coverhash, md5)
+                       aspectratio, coverhash)
+        links = self._get_links(cal_db, b_id)
+        rating = self._get_rating(cal_db, b_id)
+        fingerprint = self._fingerprint(md5, update_data, links, rating)
+        if (self._sync_state and
+                self._sync_state.fingerprint(kyb_bid) == fingerprint):
+            if self._metadata_matches(kyb_bid, update_data):
+                LOG.info('Metadata unchanged since it was last synced.')
+                return False
+            LOG.info('Metadata in KyBook 3\'s database has changed since it '
+                     'was last synced.')
         LOG.info('Updating KyBook 3\'s database ...')
-        self.execute(update_metadata_sql, update_data, log_result=True)
+        # WATCH OUT! bid needs to be the last entry.
+        self.execute(update_metadata_sql, update_data + (kyb_bid, ),
+                     log_result=True)
+        updated = self.cursor.rowcount == 1
+        self.commit()
+        self._queued_bids.append((kyb_bid, ))
+        self._ins_book_to_link_tables(links, kyb_bid)
+        self._ins_book_to_reviews(rating, kyb_bid)
+        if not self._batching:
+            self.flush()
+        if updated and self._sync_state:
+            self._sync_state.stage_fingerprint(kyb_bid, fingerprint)
+        return updated
+
+    def _metadata_matches(self, kyb_bid, update_data):
+        """ Check a book's row in the metadata table still has update_data,
+            i.e., what update() last wrote to it. """
+        sel_metadata_sql = ("""SELECT title, published, language, annotation,
+    thumbnail, aspectratio, coverhash
+FROM metadata WHERE bid = ?;""")
+        self.execute(sel_metadata_sql, (kyb_bid, ))
+        row = self.fetchone()
+        if row is None:
+            return False
+        # Blobs come back as bytes, but are written as sqlite3.Binary
+        return [bytes(value) if isinstance(value, memoryview) else value
+                for value in update_data] == list(row)
+
+    @staticmethod
+    def _fingerprint(md5, update_data, links, rating):
+        """ Get a fingerprint of the rows update() writes for a book (from
+            _get_links() and _get_rating()), using the MD5 of the thumbnail.
+        """
+        title, published, language, annotation, thumbnail, aspectratio, \
+            coverhash = update_data
+        data = [md5, title, published, language, annotation,
+                hashlib.md5(thumbnail).hexdigest(), aspectratio, coverhash,
+                [(link[0].name, link[3], link[4]) for link in links], rating]
+        return hashlib.md5(json.dumps(data).encode('utf-8')).hexdigest()
+
+    def flush(self):
+        """ Write the link table and review rows queued by update().
+            The queued books' old entries are deleted first, then the new
+            ones inserted, with one executemany() per table for all of them.
+            Inside batch() this is done by checkpoint(). """
+        if not self._queued_bids:
+            return
+        self._del_books_from_link_tables(self._queued_bids)
+        self._del_books_from_reviews(self._queued_bids)
+        for kyb_sql_fil, kyb_sql_ins, fil_rows, ins_rows in \
+                self._queued_links.values():
+            if fil_rows:
+                self.executemany(kyb_sql_fil, fil_rows)
+            if ins_rows:
+                self.executemany(kyb_sql_ins, ins_rows)
+        self._ins_books_to_reviews(self._queued_reviews)
+        self._queued_bids = []
+        self._queued_links = OrderedDict()
+        self._queued_reviews = []
         self.commit()
-        self._del_book_from_link_tables(md5)
-        self._del_book_from_reviews(md5)
-        self._ins_book_to_link_tables(cal_db, b_id, md5)
-        self._ins_book_to_reviews(cal_db, b_id, md5)
+
+    def checkpoint(self):
+        """ Commit the changes made so far, including those queued by
+            update(). """
+        self.flush()
+        super(KyBookDB, self).checkpoint()
 
     def clean_up(self):
         """ Clean up any spurious entries in the DB.
 
             Currently, this just deletes any rows in lookup tables that are
             not used, i.e., don't appear in the link tables. """
+        self.flush()
         # SQL code to delete from the lookup tables
         # E.g., 0 = subjects; 1 = s
         del_from_lookups_sql = ("""DELETE FROM {0}
@@ -448,213 +1441,275 @@ WHERE bid = (
         FROM files;""")
         return self.query(get_metadata_sql)
 
-    def send_cover_file_to_cs(self, c_s, file_path, file_row, md5):
-        """ Send a book's cover file to KyBook 3's content server."""
-        sel_bid_sql = ("""SELECT bid FROM books WHERE md5 = ?""")
-        self.execute(sel_bid_sql, (md5,), log_result=True)
-        row = self.fetchone()
-        if row:
+    def send_cover_file_to_cs(self, c_s, file_path, file_row, md5,
+                              scheduler=None, cal_datum=None, journal=None,
+                              ledger=None):
+        """ Send a book's cover file to KyBook 3's content server.
+            If a scheduler is given the upload is queued on it, for the
+            Calibre book cal_datum. Covers the journal says were uploaded by an
+            earlier run, or the ledger says haven't changed since they were
+            last uploaded, are skipped. """
+        kyb_bid = self.bid(md5)
+        if kyb_bid is not None:
             if file_path:
                 c_file = os.path.join(self._cal_lib_path, file_path,
                                       'cover.jpg')
             else:
                 c_file = os.path.join(os.path.dirname(file_row), 'cover.jpg')
-            cs_file = '$' + str(row['bid']) + '.jpg'
+            if not os.path.isfile(c_file):
+                LOG.info('No cover to upload at %s', c_file)
+                return None
+            if journal and journal.done('cover', kyb_bid):
+                LOG.info('Cover already uploaded by an earlier sync.')
+                return None
+            if ledger and ledger.unchanged(kyb_bid, md5, c_file):
+                LOG.info('Cover unchanged since it was last uploaded.')
+                return None
+            cs_file = '$' + str(kyb_bid) + '.jpg'
             LOG.debug('c_file: %s; cs_file: %s', c_file, cs_file)
-            c_s.upload_file(c_file, '/$User/covers/', cs_file,
-                            del_existing=True)
+            if scheduler:
+                key = TransferKey(cal_datum['id'], cal_datum['title'],
+                                  'cover', kyb_bid)
+                scheduler.submit(key, c_s.upload_file, c_file,
+                                 '/$User/covers/', cs_file, del_existing=True)
+                return None
+            uploaded = c_s.upload_file(c_file, '/$User/covers/', cs_file,
+                                       del_existing=True)
+            if uploaded and ledger:
+                ledger.record(kyb_bid)
+            return uploaded
+        return None
 
     def md5_exists(self, md5):
         """ Check whether an MD5 exists in the books table. """
-        # SQL to check whether md5 is already in KyBook 3's DB
-        md5_exists_sql = ("""SELECT EXISTS
-(
-    SELECT 1 FROM books WHERE md5 = ?
-) as exist;""")
-        self.execute(md5_exists_sql, (md5,), log_result=True)
-        row = self.fetchone()
-        LOG.debug(row['exist'])
-        if row['exist']:
-            return True
-        return False
+        return md5 in self._books
 
     def mod_time(self, md5):
         """ Get the timestamp (modification) of a book given its file's MD5 """
-        timestamp_sql = ("""SELECT timestamp FROM books WHERE md5 = ?;""")
-        self.execute(timestamp_sql, (md5,), log_result=True)
-        row = self.fetchone()
-        timestamp = row['timestamp']
+        timestamp = self._books[md5][1]
         LOG.debug('KyBook timestamp: %s', timestamp)
         return timestamp
 
+    def _cover_file(self, row):
+        """ Get the path of a book's cover, from a row from Calibre's DB. """
+        if row['path']:
+            return os.path.join(self._cal_lib_path, row['path'], 'cover.jpg')
+        return os.path.join(os.path.dirname(row['paths'][0]), 'cover.jpg')
+
+    def make_thumbs(self, rows, workers=THUMB_WORKERS, processes=True,
+                    conn=None):
+        """ Make the thumbnails of the covers of many books up front, on a
+            pool of workers, ready for _get_thumb().
+            Covers are shrunk on a pool of processes, or of threads if
+            processes is False (Pillow releases the GIL while decoding and
+            resizing). If the pool can't be used, _get_thumb() makes the
+            missing thumbnails as it goes. """
+        if workers < 2:
+            return
+        cover_files = []
+        # cover_files keeps the order, seen is for quick lookups
+        seen = set()
+        for row in rows:
+            cover_file = self._cover_file(row)
+            if cover_file in self._thumbs or cover_file in seen:
+                continue
+            seen.add(cover_file)
+            if not os.path.isfile(cover_file):
+                continue
+            cached = None
+            if self._thumb_cache:
+                cached = self._thumb_cache.lookup(cover_file)
+            if cached:
+                thumbnail, aspectratio = cached
+                self._thumbs[cover_file] = (sqlite3.Binary(thumbnail),
+                                            aspectratio)
+            else:
+                cover_files.append(cover_file)
+        total = len(cover_files)
+        if not total:
+            return
+        LOG.info('Making %d thumbnails with %d workers ...', total, workers)
+        executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        try:
+            with executor(max_workers=workers) as pool:
+                thumbs = pool.map(_thumbnail_or_none, cover_files,
+                                  chunksize=16)
+                for count, (cover_file, thumb) in enumerate(
+                        zip(cover_files, thumbs), 1):
+                    if thumb:
+                        thumbnail, aspectratio = thumb
+                        if self._thumb_cache:
+                            self._thumb_cache.store(cover_file, thumbnail,
+                                                    aspectratio)
+                        self._thumbs[cover_file] = (sqlite3.Binary(thumbnail),
+                                                    aspectratio)
+                    if conn:
+                        conn.send({'pass': 'Thumbnails', 'count': count,
+                                   'total': total})
+        except (OSError, BrokenExecutor) as exc:
+            LOG.warning('Could not make thumbnails in parallel: %s', exc)
+
     def _get_thumb(self, row):
         """ Get a thumbnail of a book's cover.
             Using data from a row from Calibre's DB, we follow the path to the
             cover. Then we reduce to fit KyBook's required dimensions
-            (74 x 105) and return it. """
+            (74 x 105) and return it.
+            Each cover is only shrunk once per sync, and not at all if the
+            thumbnail cache has it. """
+        cover_file = self._cover_file(row)
+        if cover_file in self._thumbs:
+            return self._thumbs[cover_file]
         thumbnail = ''
         aspectratio = 0
-        if row['path']:
-            cover_file = os.path.join(self._cal_lib_path, row['path'],
-                                      'cover.jpg')
-        else:
-            cover_file = os.path.join(os.path.dirname(row['paths'][0]),
-                                      'cover.jpg')
         try:
-            with open(cover_file, 'rb') as fyl:
-                jpg_data = fyl.read()
-            image = Image.open(BytesIO(jpg_data))
+            cached = None
+            if self._thumb_cache:
+                cached = self._thumb_cache.lookup(cover_file)
+            if cached:
+                thumbnail, aspectratio = cached
+            else:
+                thumbnail, aspectratio = make_thumbnail(cover_file)
+                if self._thumb_cache:
+                    self._thumb_cache.store(cover_file, thumbnail,
+                                            aspectratio)
         except (IOError, UnboundLocalError):
             LOG.error('An error occurred opening the image: %s', cover_file)
-        else:
-            if (image.size[0] > THUMB_WIDTH) or (image.size[1] > THUMB_HEIGHT):
-                reduced_image = self._reduce_image_size(image, THUMB_HEIGHT,
-                                                        THUMB_WIDTH)
-            else:
-                reduced_image = image
-            aspectratio = reduced_image.size[1] / (reduced_image.size[0] * 1.0)
-            output = BytesIO()
-            reduced_image.save(output, format='jpeg',
-                               optimize=True, quality=85)
-            thumbnail = output.getvalue()
-        return sqlite3.Binary(thumbnail), aspectratio
-
-    def _del_book_from_link_tables(self, md5):
-        """ Delete a book's entries from designated link tables.
+        thumb = (sqlite3.Binary(thumbnail), aspectratio)
+        self._thumbs[cover_file] = thumb
+        return thumb
+
+    def _del_books_from_link_tables(self, kyb_bids):
+        """ Delete books' entries from designated link tables.
             Spurious entries could be created by KyBook 3, if data are taken
-            from the book's file rather than Calibre's DB."""
+            from the book's file rather than Calibre's DB.
+            kyb_bids is a list of (bid, ). """
         # SQL code to delete from the link tables (books_subjects, etc.)
         # E.g., 0 = subjects
-        del_books_links_sql = ("""DELETE from books_{0}
-WHERE bid = (SELECT bid FROM books WHERE md5 = ?);""")
+        del_books_links_sql = ("""DELETE from books_{0} WHERE bid = ?;""")
         for lookup_table in self._lookup_tables:
             sql = del_books_links_sql.format(lookup_table)
-            LOG.debug('Deleting book from %s ...', lookup_table)
-            self.execute(sql, (md5,), log_result=True)
-            self.commit()
+            LOG.debug('Deleting %d books from %s ...', len(kyb_bids),
+                      lookup_table)
+            self.executemany(sql, kyb_bids)
 
-    def _del_book_from_reviews(self, md5):
-        """ Delete a book's entries from the reviews table.
+    def _del_books_from_reviews(self, kyb_bids):
+        """ Delete books' entries from the reviews table.
             Spurious entries could be created by KyBook 3, if data are taken
-            from the book's file rather than Calibre's DB."""
-        # SQL code to delete from the link tables (books_subjects, etc.)
-        # E.g., 0 = subjects
-        sql = ("""DELETE from reviews
-WHERE bid = (SELECT bid FROM books WHERE md5 = ?);""")
-        LOG.debug('Deleting book from reviews ...')
-        self.execute(sql, (md5,), log_result=True)
-        self.commit()
+            from the book's file rather than Calibre's DB.
+            kyb_bids is a list of (bid, ). """
+        sql = ("""DELETE from reviews WHERE bid = ?;""")
+        LOG.debug('Deleting %d books from reviews ...', len(kyb_bids))
+        self.executemany(sql, kyb_bids)
 
-    def _ins_book_to_reviews(self, cal_db, cal_bid, md5):
-        sel_from_cal_sql = ("""SELECT rating FROM ratings
-    WHERE id IN (SELECT id FROM books_ratings_link WHERE book = ?);""")
-        ins_review_sql = ("""INSERT OR REPLACE INTO reviews (bid, rating, timestamp)
-    VALUES((SELECT bid FROM books WHERE md5 = ?), ?, ?)
-    """)
-        if cal_db.cal_data:
-            for cal_datum in cal_db.cal_data:
-                if cal_datum['id'] == cal_bid:
-                    rating = cal_datum['rating']
-        else:
-            rating = cal_db.query(sel_from_cal_sql, (cal_bid,))
+    @staticmethod
+    def _get_rating(cal_db, cal_bid):
+        """ Get a book's rating from Calibre, or None. """
+        return cal_db.get_datum(cal_bid)['rating']
+
+    def _ins_book_to_reviews(self, rating, kyb_bid):
+        """ Queue a book's rating for flush() to insert. """
         if not rating:
             return
         LOG.debug('Inserting rating: %s', rating)
         offset = datetime(2001, 1, 1)
         timestamp = str((datetime.now() - offset).total_seconds())
-        self.execute(ins_review_sql, (md5, rating, timestamp), log_result=True)
-        self.commit()
+        self._queued_reviews.append((kyb_bid, rating, timestamp))
 
-    def _ins_book_to_link_tables(self, cal_db, cal_bid, md5):
-        """ Insert entries into designated link tables.
-            Use this to add entries from Calibre."""
-        # SQL code to select data for a book from Calibre's lookup tables
-        # 0 = tags; 1 = tag
-        sel_from_link_tables = ("""SELECT * FROM {0}
-    WHERE id IN (SELECT {1} FROM books_{0}_link WHERE book = ?);""")
-    #     # SQL code to insert into the lookup tables
-    #     # E.g., 0 = subjects; 1 = subject; 2 = '?, ?'; 3 = subject
-    #     fill_lookups_sql = ("""INSERT OR REPLACE INTO {0}({1}, timestamp)
-    # SELECT {2} WHERE NOT EXISTS(SELECT 1 FROM {0} WHERE {3} = ?);""")
-        # SQL code to insert into the lookup tables
-        # E.g., 0 = subjects; 1 = subject; 2 = '?, ?'; 3 = subject
-        fill_lookups_sql = ("""INSERT OR REPLACE INTO {0} ({1}, {2}, timestamp)
-    VALUES((SELECT {1} FROM {0} WHERE {3} LIKE ?), {4});""")
-        # SQL code to insert into the link tables (books_subjects, etc.)
-        # E.g., 0 = subjects; 1 = s; 2 = subject
-        ins_books_links_sql = ("""INSERT OR REPLACE INTO books_{0} (bid, {1})
-    SELECT books.bid, {0}.{2}
-    FROM books, {0}
-    WHERE books.md5 = ?
-    AND {0}.{3} = ?;""")
+    def _ins_books_to_reviews(self, reviews):
+        """ Insert (bid, rating, timestamp) rows into the reviews table. """
+        ins_review_sql = ("""INSERT OR REPLACE INTO reviews (bid, rating, timestamp)
+    VALUES(?, ?, ?)
+    """)
+        self.executemany(ins_review_sql, reviews)
+
+    def _lookup_cache(self, tbl):
+        """ Get the cache of a lookup table, loading it on first use.
+            The cache is a dict of the (lower case) name of an entry: [id,
+            values of tbl.midcols], mirroring the LIKE that used to find
+            existing entries. """
+        if tbl.name not in self._lookups:
+            sel_lookups_sql = ("""SELECT {0}, {1}, {2} FROM {3};""")
+            sql = sel_lookups_sql.format(tbl.xid, tbl.namecol, tbl.midcols,
+                                         tbl.name)
+            cache = {}
+            next_id = 1
+            for row in self.query(sql):
+                cache[row[1].lower()] = [row[0], tuple(row)[2:]]
+                next_id = max(next_id, row[0] + 1)
+            self._lookups[tbl.name] = cache
+            self._next_ids[tbl.name] = next_id
+        return self._lookups[tbl.name]
+
+    def _get_links(self, cal_db, cal_bid):
+        """ Get a book's entries for the designated lookup tables from
+            Calibre.
+            Returns a list of (tbl, fill SQL, link SQL, [values of
+            tbl.midcols, ...], seqnumber), for _ins_book_to_link_tables(). """
+        links = []
         seqnumber = None
-        for lookup_table in self._lookup_tables:
-            tbl = Table(lookup_table)
-            if cal_db.cal_data:
-                for cal_datum in cal_db.cal_data:
-                    if cal_datum['id'] == cal_bid:
-                        lookup_rows = cal_datum[tbl.name]
-                        if tbl.name == 'sequences':
-                            seqnumber = cal_datum.get('series_index')
-                            seqnumber = int(seqnumber) if seqnumber else seqnumber
-                        LOG.debug('lookup_rows %s', lookup_rows)
-            else:
-                if tbl.name == 'ebookids':
-                    cal_sql = ("""SELECT * FROM identifiers WHERE book = ?""")
-                else:
-                    cal_sql = sel_from_link_tables.format(tbl.calname,
-                                                          tbl.calmain)
-                lookup_rows = cal_db.query(cal_sql, (cal_bid,))
+        cal_datum = cal_db.get_datum(cal_bid)
+        for tbl, kyb_sql_fil, kyb_sql_ins in self._lookup_sql:
+            lookup_rows = cal_datum[tbl.name]
+            if tbl.name == 'sequences':
+                seqnumber = cal_datum.get('series_index')
+                seqnumber = int(seqnumber) if seqnumber else seqnumber
+            LOG.debug('lookup_rows %s', lookup_rows)
             if not lookup_rows:
                 continue
+            values_list = []
             for lookup_row in lookup_rows:
                 LOG.debug('lookup_row %s', lookup_row)
-                offset = datetime(2001, 1, 1)
-                timestamp = str((datetime.now() - offset).total_seconds())
-                kyb_sql_fil = fill_lookups_sql.format(tbl.name, tbl.xid,
-                                                      tbl.midcols, tbl.namecol,
-                                                      tbl.questions)
-                if tbl.name == 'sequences':
-                    kyb_sql_ins = ins_books_links_sql.format(tbl.name, tbl.xid + ', seqnumber',
-                                                             tbl.xid + ', ' + str(seqnumber), tbl.namecol)
-                else:
-                    kyb_sql_ins = ins_books_links_sql.format(tbl.name, tbl.xid,
-                                                             tbl.xid, tbl.namecol)
                 if tbl.name == 'authors':
-                    if not cal_db.cal_data:
-                        lookup_row = [lookup_row['name'], lookup_row['sort']]
                     name = lookup_row[0]
                     extra = lookup_row[1]
                 elif tbl.name == 'ebookids':
                     LOG.debug('lookup_row[0]: %s', lookup_row[0])
                     LOG.debug('lookup_row[1]: %s', lookup_row[1])
-                    if not cal_db.cal_data:
-                        lookup_row = [lookup_row['type'], lookup_row['value']]
                     extra = EBOOK_SCHEMES.get(lookup_row[0]) or '0'
                     name = lookup_row[1]
                 else:
-                    if not cal_db.cal_data:
-                        lookup_row = lookup_row['name']
                     name = lookup_row
                     extra = 'extra'
                 if not name or not extra:
                     continue
-                sql_fil_data = (timestamp, )
-                if tbl.name == 'authors':
-                    sql_fil_data = (extra, name) + sql_fil_data
-                    # sql_fil_data = (extra, name, None) + sql_fil_data
-                elif tbl.name == 'ebookids':
-                    sql_fil_data = (extra, name) + sql_fil_data
-                elif tbl.name == 'sequences':
-                    sql_fil_data = (name,) + sql_fil_data
-                    # sql_fil_data = (name, None) + sql_fil_data
+                # The values for tbl.midcols; the name is always last
+                if tbl.name in ('authors', 'ebookids'):
+                    values_list.append((extra, name))
+                else:
+                    values_list.append((name, ))
+            links.append((tbl, kyb_sql_fil, kyb_sql_ins, values_list,
+                          seqnumber if tbl.name == 'sequences' else None))
+        return links
+
+    def _ins_book_to_link_tables(self, links, kyb_bid):
+        """ Insert entries into designated link tables.
+            Use this to add entries from Calibre (see _get_links()).
+            New or changed entries in the lookup tables, and the book's links
+            to them (using the ids held in the lookup caches), are queued
+            for flush() to write in bulk. """
+        offset = datetime(2001, 1, 1)
+        timestamp = str((datetime.now() - offset).total_seconds())
+        for tbl, kyb_sql_fil, kyb_sql_ins, values_list, seqnumber in links:
+            cache = self._lookup_cache(tbl)
+            # Queue the fills of the lookup table and the links to it
+            _, _, fil_rows, ins_rows = self._queued_links.setdefault(
+                tbl.name, (kyb_sql_fil, kyb_sql_ins, [], []))
+            for values in values_list:
+                name = values[-1]
+                entry = cache.get(name.lower())
+                if entry is None:
+                    entry = [self._next_ids[tbl.name], None]
+                    self._next_ids[tbl.name] += 1
+                    cache[name.lower()] = entry
+                if entry[1] != values:
+                    entry[1] = values
+                    sql_fil_data = (entry[0], ) + values + (timestamp, )
+                    LOG.debug('sql_fil_data %s', sql_fil_data)
+                    fil_rows.append(sql_fil_data)
+                if tbl.name == 'sequences':
+                    ins_rows.append((kyb_bid, entry[0], seqnumber))
                 else:
-                    sql_fil_data = (name, ) + sql_fil_data
-                sql_fil_data = (name, ) + sql_fil_data
-                LOG.debug('sql_fil_data %s', sql_fil_data)
-                self.execute(kyb_sql_fil, sql_fil_data, log_result=True)
-                self.execute(kyb_sql_ins, (md5, name), log_result=True)
-                self.commit()
+                    ins_rows.append((kyb_bid, entry[0]))
 
     @staticmethod
     def _reduce_image_size(image, thumb_height, thumb_width):
@@ -697,6 +1752,89 @@ WHERE bid = (SELECT bid FROM books WHERE md5 = ?);""")
         return out
 
 
+class HTTPConnectionPool(object):
+    """ A pool of keep-alive connections to KyBook 3's content server.
+
+        Responses are read in full before a connection goes back in the pool.
+        If a pooled connection turns out to have been closed by the server the
+        request is retried once on a new connection. Servers that answer with
+        'Connection: close' simply get a new connection each time. """
+
+    def __init__(self, host, size=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT):
+        self._host = host
+        self._size = size
+        self._timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'connections': 0, 'reused': 0,
+                      'reconnects': 0}
+
+    def request(self, method, url, body=None, headers=None, sink=None):
+        """ Make a request and return a Response.
+            body may be a callable returning the body, so that a streamed
+            body can be rebuilt if the request has to be retried.
+            If sink is given the response body is streamed to sink(resp),
+            which reads it from the http.client response, instead of being
+            returned in the Response. """
+        while True:
+            http_client, reused = self._get()
+            try:
+                http_client.request(method, url,
+                                    body() if callable(body) else body,
+                                    headers or {})
+                resp = http_client.getresponse()
+                data = resp.read() if sink is None else None
+            except (http.client.HTTPException, ConnectionError) as ex:
+                http_client.close()
+                if not reused:
+                    raise
+                # The server closed the idle connection, so try a new one
+                LOG.debug('Stale connection (%s), reconnecting', ex)
+                with self._lock:
+                    self.stats['reconnects'] += 1
+                continue
+            except Exception:
+                http_client.close()
+                raise
+            if sink is not None:
+                try:
+                    sink(resp)
+                    # Whatever sink didn't want
+                    resp.read()
+                except Exception:
+                    http_client.close()
+                    raise
+            self._put(http_client, resp)
+            return Response(resp.status, resp.reason, data)
+
+    def _get(self):
+        """ Get an idle connection, or a new one. """
+        with self._lock:
+            self.stats['requests'] += 1
+            if self._idle:
+                self.stats['reused'] += 1
+                return self._idle.pop(), True
+            self.stats['connections'] += 1
+        LOG.debug('New connection to %s', self._host)
+        return http.client.HTTPConnection(self._host,
+                                          timeout=self._timeout), False
+
+    def _put(self, http_client, resp):
+        """ Return a connection to the pool, if it can be reused. """
+        with self._lock:
+            if not resp.will_close and len(self._idle) < self._size:
+                self._idle.append(http_client)
+                return
+        http_client.close()
+
+    def close(self):
+        """ Close all idle connections. """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for http_client in idle:
+            http_client.close()
+
+
 class ContentServer():
     """ Implements a driver for KyBook 3's content server."""
 
@@ -705,6 +1843,14 @@ class ContentServer():
         self._host = host
         self._username = username
         self._password = password
+        auth = '%s:%s' % (self._username, self._password)
+        credentials = b64encode(auth.encode('ascii')).decode('ascii')
+        self._headers = {'Authorization': 'Basic %s' % credentials}
+        self._pool = HTTPConnectionPool(self._host)
+        # Cached listings of remote dirs: {dir: {name: is_dir}}, or
+        # {dir: None} if the dir doesn't exist
+        self._listings = {}
+        self._listings_lock = threading.Lock()
         LOG.info('Logging in to %s', self._host)
         resp = self._http_conn('GET', '/', None)
         LOG.info(resp.reason)
@@ -721,42 +1867,103 @@ class ContentServer():
             params = urllib.parse.urlencode(payload)
         else:
             params = None
-        auth = '%s:%s' % (self._username, self._password)
-        
-        credentials = b64encode(auth.encode('ascii')).decode('ascii')
-        headers = {'Authorization': 'Basic %s' % credentials}
-        http_client = http.client.HTTPConnection(self._host)
-        http_client.request(method, url, params, headers)
-        resp = http_client.getresponse()
-        http_client.close()
-        return resp
+        return self._pool.request(method, url, params, self._headers)
 
-    def _post_multipart(self, url, fields, files, tries=5):
-        LOG.debug('Number of tries left: %d', tries)
-        if tries == 0:
+    @staticmethod
+    def _norm_path(path):
+        """ Normalise a remote path, e.g., '$User//covers/' -> '/$User/covers'
+        """
+        return '/' + '/'.join(part for part in path.split('/') if part)
+
+    def _listing(self, remote_dir):
+        """ Get the (cached) listing of a remote dir.
+            Returns {name: is_dir}, None if the dir doesn't exist or False if
+            the listing couldn't be understood. False is cached too, so the
+            fallback to HEAD requests doesn't cost a GET every time. """
+        remote_dir = self._norm_path(remote_dir)
+        with self._listings_lock:
+            if remote_dir in self._listings:
+                return self._listings[remote_dir]
+            LOG.debug('Listing %s', remote_dir)
+            resp = self._http_conn('GET', '/list?path=' + remote_dir, None)
+            LOG.debug(resp.reason)
+            if resp.status != 200:
+                listing = None
+            else:
+                try:
+                    listing = dict((item['name'], item['path'].endswith('/'))
+                                   for item in json.loads(resp.data))
+                except (ValueError, TypeError, KeyError) as ex:
+                    LOG.debug('Unable to parse listing of %s: %s',
+                              remote_dir, ex)
+                    listing = False
+            self._listings[remote_dir] = listing
+            return listing
+
+    def file_sizes(self, remote_dir):
+        """ Get the sizes of the files in a remote dir, as {name: size},
+            bypassing the cached listings. Returns None if the dir can't be
+            listed or its listing couldn't be understood. """
+        remote_dir = self._norm_path(remote_dir)
+        resp = self._http_conn('GET', '/list?path=' + remote_dir, None)
+        if resp.status != 200:
             return None
-        auth = '%s:%s' % (self._username, self._password)
-        credentials = b64encode(auth.encode('ascii')).decode('ascii')
-        content_type, body = self._encode_multipart_formdata(fields, files)
-        headers = {'Authorization': 'Basic %s' % credentials}
+        try:
+            return dict((item['name'], item.get('size'))
+                        for item in json.loads(resp.data)
+                        if not item['path'].endswith('/'))
+        except (ValueError, TypeError, KeyError, AttributeError) as ex:
+            LOG.debug('Unable to parse listing of %s: %s', remote_dir, ex)
+            return None
+
+    def _update_listing(self, remote_path, is_dir=None):
+        """ Keep the cached listings in step with our own changes.
+            is_dir is True/False for a created dir/file, None for a deletion.
+        """
+        remote_path = self._norm_path(remote_path)
+        remote_dir, name = remote_path.rsplit('/', 1)
+        remote_dir = remote_dir or '/'
+        with self._listings_lock:
+            listing = self._listings.get(remote_dir)
+            if is_dir is None:
+                if listing:
+                    listing.pop(name, None)
+                self._listings.pop(remote_path, None)
+                return
+            if isinstance(listing, dict):
+                listing[name] = is_dir
+            if is_dir:
+                self._listings[remote_path] = {}
+
+    def _post_multipart(self, url, fields, files, tries=UPLOAD_TRIES):
+        """ POST fields and files as multipart/form-data.
+            files is a list of (key, filename, local file). The body is
+            streamed from the local files, so only one chunk of each file is
+            in memory at a time. Failures are retried with exponential
+            backoff; each retry re-opens the files. """
+        content_type, parts = self._encode_multipart_formdata(fields, files)
+        headers = dict(self._headers)
         headers['Content-Type'] = content_type
-        headers['Content-Length'] = str(len(body))
+        headers['Content-Length'] = str(self._multipart_length(parts))
         LOG.debug(self._host)
-        try:
-            http_client = http.client.HTTPConnection(self._host, timeout=30)
-            # TODO: consider wrapping this in a thread with a timeout so we
-            # don't get hangs
-            http_client.request('POST', str(url), body, headers)
-            resp = http_client.getresponse()
-        except Exception as ex:
-            LOG.debug(ex)
-            time.sleep(1)
-            return self._post_multipart(url, fields, files, tries - 1)
-        finally:
-            http_client.close()
-        return resp
+        for attempt in range(tries):
+            try:
+                # TODO: consider wrapping this in a thread with a timeout so
+                # we don't get hangs
+                return self._pool.request(
+                    'POST', str(url),
+                    lambda: self._iter_multipart_body(parts), headers)
+            except Exception as ex:
+                LOG.debug('Attempt %d of %d failed: %s', attempt + 1, tries,
+                          ex)
+                if attempt + 1 < tries:
+                    time.sleep(backoff_delay(attempt))
+        return None
 
     def _encode_multipart_formdata(self, fields, files):
+        """ Build the parts of a multipart/form-data body.
+            Returns the content type and a list of parts, each of which is
+            either bytes or the path of a local file to stream. """
         limit = '-----------------------------'
         num = str(int((datetime.now() - datetime(1970, 1, 1)).total_seconds()))
         limit = limit + num
@@ -767,24 +1974,42 @@ class ContentServer():
             lines.append('Content-Disposition: form-data; name="%s"' % key)
             lines.append('')
             lines.append(value)
-        for (key, filename, value) in files:
+        parts = []
+        for (key, filename, local_file) in files:
             lines.append('--' + limit)
             lines.append('Content-Disposition: form-data; name="%s"; filename="%s"' % (key, filename))
             lines.append('Content-Type: %s' % self._get_content_type(filename))
             lines.append('')
-            lines.append(value)
+            lines.append('')
+            parts.append(crlf.join(lines).encode('utf-8'))
+            parts.append(local_file)
+            lines = ['']
         lines.append('--' + limit + '--')
         lines.append('')
-        
-        body = b''
-        for line in lines:
-            if isinstance(line,str):
-                body += line.encode('ascii') + b'\r\n'
-            else:
-                body += line + b'\r\n'
+        parts.append(crlf.join(lines).encode('utf-8'))
 
         content_type = 'multipart/form-data; boundary=%s' % limit
-        return content_type, body
+        return content_type, parts
+
+    @staticmethod
+    def _multipart_length(parts):
+        """ The exact Content-Length of a body built from parts. """
+        return sum(len(part) if isinstance(part, bytes)
+                   else os.path.getsize(part) for part in parts)
+
+    @staticmethod
+    def _iter_multipart_body(parts):
+        """ Yield the body built from parts, reading files in chunks. """
+        for part in parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            with open(part, 'rb') as fyl:
+                while True:
+                    chunk = fyl.read(UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
 
     @staticmethod
     def _get_content_type(filename):
@@ -806,6 +2031,8 @@ class ContentServer():
                 payload = {'path': path}
                 resp = self._http_conn('POST', '/create', payload)
                 LOG.info(resp.reason)
+                if resp.status == 200:
+                    self._update_listing(path, is_dir=True)
 
     def list_path(self, path):
         """ List a folder on KyBook 3's content server.
@@ -829,6 +2056,8 @@ class ContentServer():
         LOG.debug('Deleting %s', path)
         resp = self._http_conn('POST', '/delete', payload)
         LOG.debug(resp.reason)
+        if resp.status == 200:
+            self._update_listing(path)
         return resp.status == 200
 
     def download_db_file(self, path, local_path):
@@ -836,10 +2065,6 @@ class ContentServer():
         """
         self.download_file(path, local_path)
         if os.path.isfile(local_path) and os.path.getsize(local_path) > 0:
-            # We have a KyBook 3 database file, so back it up.
-            backup = local_path + datetime.now().strftime("-%Y%m%d-%H%M%S")
-            shutil.copyfile(local_path, backup)
-            LOG.info('%s copied to %s', local_path, backup)
             return True
         # No database file, so we can't continue.
         LOG.critical("No file at %s or it is empty.", local_path)
@@ -847,20 +2072,69 @@ class ContentServer():
 
     def upload_db_file(self, db_file):
         """ Add the remote dir and upload a DB file. """
-        self.upload_file(db_file, '/$App/', remote_file=None,
-                         del_existing=True)
+        return self.upload_file(db_file, '/$App/', remote_file=None,
+                                del_existing=True)
 
-    def download_file(self, remote_file, local_file):
+    def download_file(self, remote_file, local_file, md5=None,
+                      resume=False, deadline=None):
         """ Download a file from KyBook 3's content server.
-        """
+            The file is streamed to local_file + '.part' in chunks, then
+            renamed to local_file. With resume, what's already in the .part
+            file (from an earlier, interrupted download) is kept and only the
+            rest requested, with a Range header. If the file's md5 is given,
+            a local_file with that MD5 isn't downloaded again, and the
+            download is checked against it. A download still going at
+            deadline (a time.time()) is abandoned. Returns whether local_file
+            is there. """
+        if md5 and os.path.isfile(local_file) and file_md5(local_file) == md5:
+            LOG.info('%s is already at %s', remote_file, local_file)
+            return True
+        part_file = local_file + '.part'
+        offset = 0
+        if resume and os.path.isfile(part_file):
+            offset = os.path.getsize(part_file)
+        headers = dict(self._headers)
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
         LOG.info('Downloading %s to %s', remote_file, local_file)
-        resp = self._http_conn('GET', '/download?path=' + remote_file, None)
-        LOG.info("Download file")
+
+        def sink(resp):
+            if resp.status == 206:
+                LOG.info('Resuming from byte %d', offset)
+                mode = 'ab'
+            elif resp.status == 200:
+                # Range isn't supported (or wasn't asked for), start again
+                mode = 'wb'
+            else:
+                return
+            with open(part_file, mode) as fyl:
+                while True:
+                    chunk = resp.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    fyl.write(chunk)
+                    if deadline and time.time() > deadline:
+                        raise TimeoutError('out of time')
+        try:
+            resp = self._pool.request('GET', '/download?path=' + remote_file,
+                                      None, headers, sink)
+        except TimeoutError as ex:
+            LOG.error('Failed to download %s: %s', remote_file, ex)
+            return False
         LOG.info(resp.reason)
-        if resp.status == 200:
-            with open(local_file, 'wb') as fyl:
-                fyl.write(resp.read())
-            LOG.info('%s written to %s', remote_file, local_file)
+        if resp.status not in (200, 206):
+            if resp.status == 416:
+                # The .part file can't be resumed, so drop it
+                os.remove(part_file)
+            LOG.error('Failed to download %s', remote_file)
+            return False
+        if md5 and file_md5(part_file) != md5:
+            LOG.error('MD5 of %s does not match, discarding it', remote_file)
+            os.remove(part_file)
+            return False
+        os.replace(part_file, local_file)
+        LOG.info('%s written to %s', remote_file, local_file)
+        return True
 
     def upload_file(self, local_file, remote_dir, remote_file=None,
                     del_existing=False):
@@ -869,11 +2143,9 @@ class ContentServer():
         """
         LOG.debug('del_existing: %s', del_existing)
         url = '/upload'
-        file_handle = open(local_file, 'rb')
-        contents = file_handle.read()
         if not remote_file:
             remote_file = str(os.path.basename(local_file))
-        files = [('files[]', remote_file, contents)]
+        files = [('files[]', remote_file, local_file)]
         data = [('path', remote_dir)]
         if del_existing:
             # We cannot use os.path.join here because Windows puts \ not /
@@ -891,13 +2163,33 @@ class ContentServer():
         print('Done the request')
         if resp:
             LOG.info(resp.reason)
-        else:
-            LOG.info('Failed!')
+            if resp.status == 200:
+                self._update_listing(remote_dir + '/' + remote_file,
+                                     is_dir=False)
+            return resp.status == 200
+        LOG.info('Failed!')
+        return False
+
+    def log_stats(self):
+        """ Report how many connections to the content server were reused. """
+        stats = self._pool.stats
+        LOG.info('HTTP: %d requests, %d connections opened, %d reused, '
+                 '%d reconnects', stats['requests'], stats['connections'],
+                 stats['reused'], stats['reconnects'])
+
+    def close(self):
+        """ Close any open connections to the content server. """
+        self._pool.close()
 
     def file_exists(self, remote_file):
         """ Check file exists on KyBook 3's content server.
+            Answered from the cached listing of the file's dir, if possible.
         """
         LOG.debug('Checking existence of %s', remote_file)
+        remote_dir, name = self._norm_path(remote_file).rsplit('/', 1)
+        listing = self._listing(remote_dir or '/')
+        if listing is not False:
+            return bool(listing) and listing.get(name) is False
         resp = self._http_conn('HEAD', '/download?path=' + remote_file, None)
         LOG.debug(resp.reason)
         # Return True if file exists
@@ -905,8 +2197,12 @@ class ContentServer():
 
     def dir_exists(self, remote_dir):
         """ Check directory exists on KyBook 3's content server.
+            Answered from the cached listings, if possible.
         """
         LOG.debug('Checking existence of %s', remote_dir)
+        listing = self._listing(remote_dir)
+        if listing is not False:
+            return listing is not None
         resp = self._http_conn('HEAD', '/list?path=' + remote_dir, None)
         LOG.debug(resp.reason)
         # Return True if directory exists
@@ -933,6 +2229,130 @@ class ContentServer():
         return allparts
 
 
+class TransferScheduler(object):
+    """ Run transfers to/from KyBook 3's content server in parallel.
+
+        At most limit transfers run at once; KyBook 3's embedded server may
+        not cope with many parallel writers, so keep the limit small. Each
+        transfer is queued under a key (e.g., a TransferKey) and wait()
+        reports which keys had a failure. on_success(key) is called from the
+        worker thread as soon as a transfer succeeds. """
+
+    def __init__(self, limit=UPLOAD_WORKERS, on_success=None):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, limit))
+        self._futures = []
+        self._on_success = on_success
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._executor.shutdown(wait=True)
+
+    def submit(self, key, func, *args, **kwargs):
+        """ Queue func(*args, **kwargs). A result of False, or an exception,
+            counts as a failure. """
+        self._futures.append((key, self._executor.submit(
+            self._run, key, func, *args, **kwargs)))
+
+    def _run(self, key, func, *args, **kwargs):
+        """ Run a transfer in a worker thread. """
+        result = func(*args, **kwargs)
+        if result is not False and self._on_success:
+            self._on_success(key)
+        return result
+
+    def wait(self, progress=None):
+        """ Wait for everything queued so far, calling progress(done, total)
+            as each transfer finishes.
+            Returns a list of (key, succeeded), in the order queued. """
+        results = []
+        total = len(self._futures)
+        for done, (key, future) in enumerate(self._futures, 1):
+            try:
+                succeeded = future.result() is not False
+            except Exception as ex:
+                LOG.error('Transfer for %s failed: %s', key, ex)
+                succeeded = False
+            results.append((key, succeeded))
+            if progress:
+                progress(done, total)
+        self._futures = []
+        return results
+
+
+class Snapshots(object):
+    """ Compressed, rotating snapshots of KyBook 3's DB.
+
+        A snapshot is copied with SQLite's online backup API, so it's
+        consistent even while the DB is open. take() makes that copy on the
+        caller's thread, as the DB is changed (or replaced) straight after;
+        only gzipping it into the snapshot dir, and deleting the oldest
+        snapshots with the same label so only keep are left, is done by a
+        background thread. wait() waits for the snapshots being gzipped. """
+
+    def __init__(self, directory, keep=SNAPSHOT_KEEP):
+        self._dir = directory
+        self._keep = keep
+        self._threads = []
+        os.makedirs(directory, exist_ok=True)
+
+    def take(self, db_file, label):
+        """ Snapshot db_file. Returns the file the snapshot will be in. """
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        snapshot = os.path.join(self._dir, 'db-%s-%s.sqlite.gz'
+                                % (label, stamp))
+        copy = snapshot[:-len('.gz')] + '.tmp'
+        src = sqlite3.connect(db_file)
+        dst = sqlite3.connect(copy)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+        thread = threading.Thread(target=self._compress,
+                                  args=(copy, snapshot, label),
+                                  name='snapshot-' + label)
+        thread.start()
+        self._threads.append(thread)
+        return snapshot
+
+    def _compress(self, copy, snapshot, label):
+        """ gzip a copy of the DB to snapshot, then rotate the snapshots. """
+        try:
+            with open(copy, 'rb') as src, \
+                    gzip.open(snapshot + '.part', 'wb',
+                              compresslevel=SNAPSHOT_COMPRESSION) as dst:
+                shutil.copyfileobj(src, dst, HASH_CHUNK_SIZE)
+            os.replace(snapshot + '.part', snapshot)
+            LOG.info("Snapshot of KyBook 3's DB saved to %s", snapshot)
+        except OSError as ex:
+            LOG.error('Failed to save snapshot %s: %s', snapshot, ex)
+            return
+        finally:
+            if os.path.exists(copy):
+                os.remove(copy)
+        self._rotate(label)
+
+    def _rotate(self, label):
+        """ Delete all but the newest keep snapshots with label. """
+        # The timestamps in the names sort in date order
+        snapshots = sorted(glob.glob(os.path.join(
+            self._dir, 'db-%s-*.sqlite.gz' % glob.escape(label))))
+        for old in snapshots[:-self._keep]:
+            LOG.debug('Removing old snapshot %s', old)
+            try:
+                os.remove(old)
+            except OSError as ex:
+                LOG.warning('Failed to remove snapshot %s: %s', old, ex)
+
+    def wait(self):
+        """ Wait for the snapshots taken so far to be saved. """
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
 class PathType():
     """ Ensure the download_dir given on the command line is valid.
 
@@ -1000,6 +2420,27 @@ class PathType():
         return string
 
 
+def id_list(string):
+    """ Argument type for a comma separated list of book ids. """
+    try:
+        return [int(b_id) for b_id in string.split(',') if b_id.strip()]
+    except ValueError:
+        raise err("not a list of book ids: '%s'" % string)
+
+
+def calibre_time(string):
+    """ Argument type for a date (and time), in UTC, e.g., 2019-05-31 or
+        '2019-05-31 18:30'. Returned in the format of Calibre's
+        last_modified, so it can be compared with it in SQL. """
+    try:
+        stamp = datetime.fromisoformat(string)
+    except ValueError:
+        raise err("not a date: '%s'" % string)
+    if stamp.tzinfo:
+        stamp = stamp.astimezone(timezone.utc)
+    return str(stamp.replace(tzinfo=timezone.utc))
+
+
 def parse_arguments():
     """ Parse the arguments. """
     parser = argparse.ArgumentParser(
@@ -1020,7 +2461,8 @@ def parse_arguments():
     # parser.add_argument('-t', '--trial-run', help='do NOT upload any files',
     #                     action='store_true')
     parser.add_argument('-d', '--download_dir',
-                        help='Download directory for books not in Calibre',
+                        help='Download directory for books not in Calibre '
+                             '(all of Calibre is checked, whatever the filters)',
                         type=PathType(exists=True, typ='dir', dash_ok='False'),
                         metavar='/download/dir/')
     parser.add_argument('-l', '--log_level', help='level of logging provided',
@@ -1028,6 +2470,56 @@ def parse_arguments():
                                  'debug'])
     parser.add_argument('-f', '--filename', help='filename to save log to',
                         metavar='filename.ext')
+    parser.add_argument('-c', '--cache-dir',
+                        help='Directory for the local caches (e.g., of MD5s)',
+                        type=PathType(exists=True, typ='dir', dash_ok='False'),
+                        metavar='/cache/dir/')
+    parser.add_argument('--snapshot-dir',
+                        help='Directory for the snapshots of KyBook3\'s DB '
+                             '(default: %s)' % SNAPSHOT_DIR,
+                        type=PathType(exists=True, typ='dir', dash_ok='False'),
+                        metavar='/snapshot/dir/')
+    parser.add_argument('-w', '--hash-workers', type=int,
+                        help='number of files to hash in parallel '
+                             '(default: number of CPUs)')
+    parser.add_argument('-u', '--upload-workers', type=int,
+                        help='number of files to upload in parallel '
+                             '(default: %d)' % UPLOAD_WORKERS)
+    parser.add_argument('--thumb-workers', type=int,
+                        help='number of covers to shrink to thumbnails in '
+                             'parallel (default: number of CPUs)')
+    parser.add_argument('--ids', type=id_list, metavar='ID,ID,...',
+                        help='only sync the books with these ids')
+    parser.add_argument('--tag', dest='tags', action='append',
+                        help='only sync books with this tag (can be repeated)')
+    parser.add_argument('--series', action='append',
+                        help='only sync books in this series (can be '
+                             'repeated)')
+    parser.add_argument('--format', dest='formats', action='append',
+                        help='only sync files in this format, e.g., EPUB '
+                             '(can be repeated)')
+    parser.add_argument('--modified-after', type=calibre_time,
+                        metavar='DATE',
+                        help='only sync books modified on or after this UTC '
+                             'date (and time)')
+    parser.add_argument('--modified-before', type=calibre_time,
+                        metavar='DATE',
+                        help='only sync books modified before this UTC date '
+                             '(and time)')
+    parser.add_argument('--download-workers', type=int,
+                        help='number of files to download in parallel '
+                             '(default: %d)' % DOWNLOAD_WORKERS)
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='only sync books changed since they were last '
+                             'synced')
+    parser.add_argument('-s', '--sql-trace', action='store_true',
+                        help='log every SQL statement run (with debug)')
+    parser.add_argument('--text-dumps', action='store_true',
+                        help="write text dumps of KyBook3's DB before and "
+                             "after the sync (slow; for debugging)")
+    parser.add_argument('--ready-timeout', type=int,
+                        help='seconds to wait for KyBook3 to add uploaded '
+                             'files (default: %d)' % READY_TIMEOUT)
     parser.add_argument('-', '--cal-data', help=argparse.SUPPRESS)
     # Always print help if we don't have 4 args (script, server, user, & pass)
     if len(sys.argv) < 5:
@@ -1039,14 +2531,21 @@ def parse_arguments():
 
 
 def main(library_path, content_server, username, password, remove_html,
-         download_dir, log_level, filename, cal_data):
+         download_dir, log_level, filename, cal_data, cache_dir=None,
+         hash_workers=None, upload_workers=None, ready_timeout=None,
+         thumb_workers=None, sql_trace=False, incremental=False, ids=None,
+         tags=None, series=None, formats=None, modified_after=None,
+         modified_before=None, download_workers=None, text_dumps=False,
+         snapshot_dir=None):
     """ Where the work is done."""
     
     if not log_level:
-        log_level = 'debug'
+        # Calibre isn't in debug mode, so keep the automatic log light
+        log_level = 'info'
         filename = os.path.join(tempfile.gettempdir(), 'KyBook3Sync.log')
     
     setup_logging(log_level, filename)
+    Database.trace_sql = sql_trace
     
     LOG.debug(f'{library_path}, {content_server}, {username}, {password}, {remove_html},\
               {download_dir}, {log_level}, {filename}')
@@ -1069,38 +2568,149 @@ def main(library_path, content_server, username, password, remove_html,
     except Exception as e:
         LOG.info(f'Could not connect to the Content Server {content_server}. Did you start it?')
         print(e)
-        conn.send('no c_s')
+        if conn:
+            conn.send('no c_s')
+        return
+    md5_cache = Md5Cache(os.path.join(cache_dir or CACHE_DIR, MD5_CACHE_FILE))
+    sync_state = SyncState(os.path.join(cache_dir or CACHE_DIR,
+                                        SYNC_STATE_FILE),
+                           library_path, content_server)
+    # Calibre's last_modified is in UTC, in this format
+    started = str(datetime.now(timezone.utc))
+    book_filter = BookFilter(ids, tags, series, formats, modified_after,
+                             modified_before)
+    cal_db = CalibreDB(os.path.join(library_path, 'metadata.db'), cal_data,
+                       md5_cache, book_filter=book_filter)
+    manifest = cal_db.get_manifest(conn, hash_workers or HASH_WORKERS,
+                                   sync_state=sync_state if incremental
+                                   else None)
+    if not manifest and not download_dir:
+        # KyBook 3's DB doesn't even need downloading
+        LOG.info('No books to sync (or nothing has changed since the last '
+                 'sync).')
+        cal_db.close()
+        md5_cache.close()
+        sync_state.close()
+        if conn:
+            conn.send({'failed': []})
+            conn.send('close')
+            conn.close()
+        c_s.close()
         return
-    cal_db = CalibreDB(os.path.join(library_path, 'metadata.db'), cal_data)
-    iterate_cal_data(c_s, cal_db, 'File sync', remove_html, conn, library_path)
-    cal_book_file_md5s = iterate_cal_data(c_s, cal_db, 'Metadata sync',
-                                          remove_html, conn, library_path)
+    session = SyncJournal.session_id(content_server, library_path,
+                                     [cal_datum['id'] for cal_datum, _
+                                      in manifest])
+    journal = SyncJournal(os.path.join(cache_dir or CACHE_DIR, JOURNAL_FILE),
+                          session)
+    upload_workers = upload_workers or UPLOAD_WORKERS
+    # Download KyBook 3's DB once; it's only re-fetched if we upload files
+    if not c_s.download_db_file(KYB_DB_URL, KYB_DB_FILE):
+        LOG.info('Failed to download the DB file from KyBook3')
+        sys.exit(1)
+    # Back up KyBook 3's DB before it's changed
+    snapshots = Snapshots(snapshot_dir or SNAPSHOT_DIR)
+    snapshots.take(KYB_DB_FILE, 'start')
+    if text_dumps:
+        with KyBookDB(KYB_DB_FILE, remove_html, library_path) as kyb_db:
+            kyb_db.dump(KYB_DB_FILE + '_start.txt')
+    if ready_timeout is None:
+        ready_timeout = READY_TIMEOUT
+    failed = iterate_cal_data(c_s, cal_db, manifest, 'File sync', remove_html,
+                              conn, library_path, upload_workers, journal,
+                              ready_timeout)
+    thumb_cache = ThumbCache(os.path.join(cache_dir or CACHE_DIR,
+                                          THUMB_CACHE_FILE))
+    cover_ledger = CoverLedger(os.path.join(cache_dir or CACHE_DIR,
+                                            COVER_LEDGER_FILE),
+                               content_server, md5_cache)
+    failed += iterate_cal_data(c_s, cal_db, manifest, 'Metadata sync',
+                               remove_html, conn, library_path, upload_workers,
+                               journal, thumb_cache=thumb_cache,
+                               thumb_workers=thumb_workers or THUMB_WORKERS,
+                               cover_ledger=cover_ledger,
+                               sync_state=sync_state)
+    thumb_cache.prune()
+    thumb_cache.log_stats()
+    thumb_cache.close()
+    cover_ledger.log_stats()
+    cover_ledger.close()
+    # Each book only needs reporting once
+    failed_ids = list(OrderedDict.fromkeys(failed))
+    if download_dir:
+        # Every book Calibre has, not just the ones selected for this sync
+        cal_book_file_md5s = cal_db.get_library_md5s(
+            dict((entry.b_file, entry.md5) for _, entries in manifest
+                 for entry in entries), hash_workers or HASH_WORKERS)
     cal_db.close()
+    md5_cache.prune()
+    md5_cache.log_stats()
+    md5_cache.close()
     if download_dir:
         # new_books = []
-        kyb_db = KyBookDB(KYB_DB_FILE, remove_html, library_path)
-        kyb_data = kyb_db.get_metadata()
-        for kyb_datum in kyb_data:
-            if not kyb_datum['md5'] in cal_book_file_md5s:
-                # new_book = []
-                # We CANNOT use os.path.join because Windows puts \ not /
-                remote_file = '/' + kyb_datum['path']
-                local_file = os.path.basename(remote_file)
-                local_file = os.path.join(download_dir, local_file)
-                c_s.download_file(remote_file, local_file)
+        with KyBookDB(KYB_DB_FILE, remove_html, library_path) as kyb_db:
+            kyb_data = kyb_db.get_metadata()
+        with TransferScheduler(download_workers or DOWNLOAD_WORKERS) \
+                as scheduler:
+            for kyb_datum in kyb_data:
+                if not kyb_datum['md5'] in cal_book_file_md5s:
+                    # new_book = []
+                    # We CANNOT use os.path.join because Windows puts \ not /
+                    remote_file = '/' + kyb_datum['path']
+                    local_file = os.path.basename(remote_file)
+                    local_file = os.path.join(download_dir, local_file)
+                    key = TransferKey(None, remote_file, 'download',
+                                      kyb_datum['md5'])
+                    scheduler.submit(key, c_s.download_file, remote_file,
+                                     local_file, kyb_datum['md5'],
+                                     resume=True)
+            failed_downloads = [key.title for key, succeeded
+                                in scheduler.wait() if not succeeded]
+        if failed_downloads:
+            LOG.error('%d files failed to download, rerun to resume them: '
+                      '%s', len(failed_downloads), failed_downloads)
     with KyBookDB(KYB_DB_FILE, remove_html, library_path) as kyb_db:
         kyb_db.set_collation(ON)
-        kyb_db.dump(KYB_DB_FILE + '_end.txt')
-    conn.send({'pass': 'Uploading DB file', 'count': 0, 'total': 1})
-    c_s.upload_db_file(KYB_DB_FILE)
-    conn.send({'pass': 'Uploading DB file', 'count': 1, 'total': 1})
+        if text_dumps:
+            kyb_db.dump(KYB_DB_FILE + '_end.txt')
+    snapshots.take(KYB_DB_FILE, 'end')
+    if conn:
+        conn.send({'pass': 'Uploading DB file', 'count': 0, 'total': 1})
+    if c_s.upload_db_file(KYB_DB_FILE):
+        # The metadata written to the local copy is now in KyBook 3
+        journal.record_staged()
+        failed_books = set(b_id for b_id, _ in failed_ids)
+        synced = [(cal_datum['id'], cal_datum['last_modified'],
+                   file_signature(entry.b_file for entry in entries))
+                  for cal_datum, entries in manifest
+                  if cal_datum['id'] not in failed_books]
+        # Incremental syncs start from the last sync of the whole library;
+        # failed books are forgotten, so they're picked up again
+        whole_library = not cal_data and not any(book_filter)
+        sync_state.record(synced, started if whole_library else None,
+                          failed_books)
+    else:
+        failed_ids = [(cal_datum['id'], cal_datum['title'])
+                      for cal_datum, _ in manifest]
+    if conn:
+        conn.send({'pass': 'Uploading DB file', 'count': 1, 'total': 1})
+    if failed_ids:
+        LOG.error('%d books had failed uploads, rerun to resume the sync',
+                  len(failed_ids))
+    else:
+        journal.finish()
+    journal.close()
+    sync_state.close()
     if conn:
+        conn.send({'failed': failed_ids})
         conn.send('close')
         conn.close()
     print('To use the uploaded covers, clear the book covers cache.')
     print('In KyBook 3, tap Control | Cache | BOOK COVERS CACHE |'
           ' Clear space')
     print('Then close and re-open KyBook 3.')
+    c_s.log_stats()
+    c_s.close()
+    snapshots.wait()
     LOG.info('All done.')
     # return new_books[]
 
@@ -1137,58 +2747,173 @@ def setup_logging(level, filename):
         # LOG.addHandler(handler)
 
 
-def iterate_cal_data(c_s, cal_db, iteration, remove_html, conn, library_path):
+def wait_for_kybook(c_s, md5s, conn, timeout=READY_TIMEOUT):
+    """ Wait for KyBook 3 to add newly uploaded files to its DB.
+        KyBook 3's DB is polled, with backoff, until it has all the MD5s or
+        the timeout is reached. Polling only lists the DB's dir; the DB is
+        only downloaded again when its files' sizes have changed (or can't
+        be listed), or READY_REFRESH secs after the last download. A
+        download can't run past the timeout. Each download
+        replaces the local copy of the DB, so afterwards it is as up to date
+        as possible. If no files were uploaded the local copy is still
+        current, so nothing is downloaded.
+        Returns the set of MD5s KyBook 3 still hasn't added (empty if it's
+        ready). """
+    if not md5s:
+        LOG.info('No files uploaded, so no need to wait for KyBook3')
+        return set()
+    sel_md5s_sql = ("""SELECT md5 FROM books WHERE md5 IN ({0});""")
+    probe_file = KYB_DB_FILE + '.probe'
+    db_dir, db_name = KYB_DB_URL.rsplit('/', 1)
+    md5s = set(md5s)
+    found = set()
+    LOG.info('Waiting for KyBook3 to add %d files ...', len(md5s))
+    start = time.time()
+    attempt = 0
+    # Sizes of the DB's files (e.g., db.sqlite-wal too) when last downloaded
+    last_sizes = None
+    last_download = start
+    while True:
+        sizes = c_s.file_sizes(db_dir)
+        if sizes is not None:
+            sizes = sorted(item for item in sizes.items()
+                           if item[0].startswith(db_name))
+        if (sizes is not None and sizes == last_sizes and
+                time.time() - last_download < READY_REFRESH):
+            LOG.debug('KyBook3\'s DB has not changed')
+        elif c_s.download_file(KYB_DB_URL, probe_file,
+                               deadline=start + timeout):
+            last_sizes = sizes
+            last_download = time.time()
+            with Database(probe_file) as probe_db:
+                sql = sel_md5s_sql.format(', '.join('?' * len(md5s)))
+                found = set(row['md5']
+                            for row in probe_db.query(sql, tuple(md5s)))
+            os.replace(probe_file, KYB_DB_FILE)
+            LOG.debug('KyBook3 has %d of %d files', len(found), len(md5s))
+            if found >= md5s:
+                LOG.info('OK')
+                return set()
+        waited = time.time() - start
+        if waited >= timeout:
+            missing = md5s - found
+            LOG.error('Gave up waiting for KyBook3 after %ds; it has not '
+                      'added %d files', timeout, len(missing))
+            return missing
+        if conn:
+            conn.send({'pass': 'Waiting', 'count': min(waited, timeout),
+                       'total': timeout})
+        delay = min(2 ** attempt, READY_POLL_MAX, timeout - waited)
+        attempt += 1
+        time.sleep(delay)
+
+
+def iterate_cal_data(c_s, cal_db, manifest, iteration, remove_html, conn,
+                     library_path, upload_workers=UPLOAD_WORKERS,
+                     journal=None, ready_timeout=READY_TIMEOUT,
+                     thumb_cache=None, thumb_workers=THUMB_WORKERS,
+                     cover_ledger=None, sync_state=None):
     """ Iterate over Calibre's data.
         We need to go over them twice: once to upload files, then to update
-        KyBook 3's DB. """
-    cal_book_file_md5s = []
-    if c_s.download_db_file(KYB_DB_URL, KYB_DB_FILE):
-        with KyBookDB(KYB_DB_FILE, remove_html, library_path) as kyb_db:
-            if iteration == 'File sync':
-                kyb_db.dump(KYB_DB_FILE + '_start.txt')
-            kyb_db.set_collation(OFF)
-        kyb_db = KyBookDB(KYB_DB_FILE, remove_html, library_path)
-        cal_data = cal_db.get_metadata()
-        count = 0
-        total = len(cal_data)
-        LOG.info('Total no. of books to sync: %s', total)
-        for cal_datum in cal_data:
+        KyBook 3's DB. Both passes use the same manifest, so each file is
+        only hashed once per sync, and the local copy of KyBook 3's DB
+        downloaded by main().
+        Uploads are queued on a TransferScheduler; returns the (book id,
+        title) of books with a failed upload, or with a file KyBook 3
+        didn't add to its DB (so its metadata couldn't be synced). Anything
+        the journal says was done by an earlier, failed run is skipped.
+        Writes to KyBook 3's DB are batched, BATCH_SIZE books per commit.
+        After the file sync we wait (up to ready_timeout secs) for KyBook 3
+        to add the uploaded files to its DB. Thumbnails of covers are taken
+        from thumb_cache, if given, or made before the metadata sync on a
+        pool of thumb_workers. Covers cover_ledger says are unchanged aren't
+        uploaded. Metadata sync_state says is unchanged isn't rewritten. """
+    failed_ids = []
+    uploaded = []
+    if not os.path.isfile(KYB_DB_FILE):
+        LOG.info('No local copy of the DB file from KyBook3')
+        sys.exit(1)
+    with KyBookDB(KYB_DB_FILE, remove_html, library_path) as kyb_db:
+        kyb_db.set_collation(OFF)
+    kyb_db = KyBookDB(KYB_DB_FILE, remove_html, library_path, thumb_cache,
+                      sync_state)
+
+    def on_success(key):
+        if journal:
+            journal.record(key.kind, key.item)
+        if cover_ledger and key.kind == 'cover':
+            cover_ledger.record(key.item)
+    scheduler = TransferScheduler(upload_workers, on_success)
+    count = 0
+    total = len(manifest)
+    LOG.info('Total no. of books to sync: %s', total)
+    if iteration == 'Metadata sync':
+        # Only the books whose metadata will be updated need thumbnails
+        rows = [cal_datum for cal_datum, entries in manifest
+                if any(kyb_db.md5_exists(entry.md5) and not
+                       (journal and journal.done('metadata', entry.md5))
+                       for entry in entries)]
+        # From the plugin we run inside Calibre's GUI, so use threads there
+        kyb_db.make_thumbs(rows, thumb_workers, not cal_db.cal_data, conn)
+    with kyb_db.batch():
+        for cal_datum, entries in manifest:
             count = count + 1
             LOG.info('Processing %s/%s books: %s ...', count, total,
                      cal_datum['title'])
             LOG.debug('Book ID: %s', cal_datum['id'])
-            cal_bid = cal_datum['id']
             cal_path = cal_datum['path']
-            for file_row in cal_db.get_books_files(cal_bid):
-                md5 = cal_db.get_md5(cal_path, file_row)
+            for entry in entries:
+                md5 = entry.md5
                 if iteration == 'File sync':
-                    if not kyb_db.md5_exists(md5):
-                        cal_db.send_book_file_to_cs(c_s, cal_path, file_row)
+                    if journal and journal.done('file', md5):
+                        LOG.info('File already uploaded by an earlier sync.')
+                    elif not kyb_db.md5_exists(md5):
+                        key = TransferKey(cal_datum['id'], cal_datum['title'],
+                                          'file', md5)
+                        cal_db.send_book_file_to_cs(c_s, cal_path,
+                                                    entry.file_row,
+                                                    scheduler, key)
                     else:
                         LOG.info('File already in KyBook 3.')
                 elif iteration == 'Metadata sync':
-                    cal_book_file_md5s.append(md5)
-                    LOG.debug('Book MD5s list: %s', cal_book_file_md5s)
-                    kyb_db.update(cal_db, cal_datum, md5)
-                    kyb_db.send_cover_file_to_cs(c_s, cal_path, file_row, md5)
+                    if journal and journal.done('metadata', md5):
+                        LOG.info('Metadata already synced by an earlier sync.')
+                    elif not kyb_db.md5_exists(md5):
+                        # Don't let the sync state count it as synced
+                        LOG.error('File not in KyBook 3\'s database, so its '
+                                  'metadata can\'t be synced.')
+                        failed_ids.append((cal_datum['id'],
+                                           cal_datum['title']))
+                    elif kyb_db.update(cal_db, cal_datum, md5) and journal:
+                        journal.stage('metadata', md5)
+                    kyb_db.send_cover_file_to_cs(c_s, cal_path,
+                                                 entry.file_row, md5,
+                                                 scheduler, cal_datum,
+                                                 journal, cover_ledger)
+            if count % BATCH_SIZE == 0:
+                kyb_db.checkpoint()
             if conn:
                 conn.send({'pass': iteration, 'count': count, 'total': total})
-        if iteration == 'File sync':
-            LOG.info('Waiting for KyBook3 ...')
-            total = 20
-            for sec in range(1, total + 1):
-                time.sleep(1)
-                if conn:
-                    conn.send({'pass': 'Waiting', 'count': sec,
-                              'total': total})
-            LOG.info('OK')
         if iteration == 'Metadata sync':
             kyb_db.clean_up()
-        kyb_db.close()
-    else:
-        LOG.info('Failed to download the DB file from KyBook3')
-        sys.exit(1)
-    return cal_book_file_md5s
+    kyb_db.close()
+    LOG.info('Waiting for uploads to finish ...')
+
+    def progress(done, total):
+        if conn:
+            conn.send({'pass': 'Uploading', 'count': done, 'total': total})
+    with scheduler:
+        for key, succeeded in scheduler.wait(progress):
+            if not succeeded:
+                failed_ids.append((key.bid, key.title))
+            elif key.kind == 'file':
+                uploaded.append(key)
+    if iteration == 'File sync':
+        missing = wait_for_kybook(c_s, [key.item for key in uploaded], conn,
+                                  ready_timeout)
+        failed_ids += [(key.bid, key.title) for key in uploaded
+                       if key.item in missing]
+    return failed_ids
 
 
 if __name__ == '__main__':
@@ -10,10 +10,10 @@ __docformat__ = 'restructuredtext en'
 from collections import OrderedDict
 try:
     from PyQt5 import QtWidgets as QtGui
-    from PyQt5.Qt import QWidget, QGridLayout, QLabel, QLineEdit, QCheckBox
+    from PyQt5.Qt import QWidget, QGridLayout, QLabel, QLineEdit, QCheckBox, QSpinBox
 except ImportError as e:
     from PyQt4 import QtGui
-    from PyQt4.Qt import QWidget, QGridLayout, QLabel, QLineEdit, QCheckBox
+    from PyQt4.Qt import QWidget, QGridLayout, QLabel, QLineEdit, QCheckBox, QSpinBox
 from calibre.utils.config import JSONConfig
 
 KEY_CONTENT_SERVER = 'content_server'
@@ -21,6 +21,8 @@ KEY_USERNAME = 'username'
 KEY_PASSWORD = 'password'
 KEY_FORMATS = 'formats'
 KEY_REMOVE_HTML = 'remove_html'
+KEY_UPLOAD_WORKERS = 'upload_workers'
+KEY_INCREMENTAL = 'incremental'
 
 # SHOW_REMOVE_HTML = OrderedDict([('no', 'No'),
                         # ('yes', 'Yes')])
@@ -30,7 +32,9 @@ DEFAULT_STORE_VALUES = {
     KEY_USERNAME: 'guest',
     KEY_PASSWORD: 'password',
     KEY_FORMATS: ['EPUB', 'PDF', 'MOBI', 'AZW3', 'AZW4', 'DJVU'],
-    KEY_REMOVE_HTML: 0
+    KEY_REMOVE_HTML: 0,
+    KEY_UPLOAD_WORKERS: 2,
+    KEY_INCREMENTAL: 0
 }
 
 # This is where all preferences for this plugin will be stored
@@ -77,6 +81,17 @@ class ConfigWidget(QWidget):
         self.html_checkbox.setChecked(html)
         layout.addWidget(self.html_checkbox, 10, 0, 1, 2)
 
+        layout.addWidget(QLabel('Number of files to upload at the same time (lower this if KyBook3 struggles):', self), 11, 0, 1, 2)
+        self.upload_workers_spin = QSpinBox(self)
+        self.upload_workers_spin.setRange(1, 8)
+        self.upload_workers_spin.setValue(c.get(KEY_UPLOAD_WORKERS, DEFAULT_STORE_VALUES[KEY_UPLOAD_WORKERS]))
+        layout.addWidget(self.upload_workers_spin, 12, 0, 1, 2)
+
+        self.incremental_checkbox = QCheckBox('Only sync books that have changed since they were last synced?', self)
+        incremental = c.get(KEY_INCREMENTAL, DEFAULT_STORE_VALUES[KEY_INCREMENTAL])
+        self.incremental_checkbox.setChecked(incremental)
+        layout.addWidget(self.incremental_checkbox, 13, 0, 1, 2)
+
     def save_settings(self):
         prefs[KEY_CONTENT_SERVER] = str(self.c_s_ledit.text())
         prefs[KEY_USERNAME] = str(self.username_ledit.text())
@@ -84,3 +99,5 @@ class ConfigWidget(QWidget):
         formats = str(self.formats_ledit.text()).replace(' ','')
         prefs[KEY_FORMATS] = formats.split(',')
         prefs[KEY_REMOVE_HTML] = self.html_checkbox.isChecked()
+        prefs[KEY_UPLOAD_WORKERS] = self.upload_workers_spin.value()
+        prefs[KEY_INCREMENTAL] = self.incremental_checkbox.isChecked()
@@ -7,14 +7,14 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake <grant.drake@gmail.com>'
 __docformat__ = 'restructuredtext en'
 
-import sys, time
+import os, sys, time
 from threading import Event
 from threading import Thread
 from multiprocessing.connection import Listener
 
 from calibre.gui2.convert.single import sort_formats_by_preference
 from calibre.gui2.threaded_jobs import ThreadedJob
-from calibre.utils.config import prefs as cal_prefs
+from calibre.utils.config import prefs as cal_prefs, config_dir
 from calibre.utils.ipc.server import Server
 from calibre.utils.ipc.job import ParallelJob
 from calibre.utils.logging import Log
@@ -50,6 +50,8 @@ def sync_threaded(gui, ids, db, log=None, abort=None, notifications=None):
     the sync of the book(s) from a separate thread.
     '''
     library_path = cal_prefs['library_path']
+    # Keep the local caches next to the plugin's prefs
+    cache_dir = os.path.join(config_dir, 'plugins')
     content_server = prefs['content_server']
     log_level = None
     if DEBUG:
@@ -58,6 +60,8 @@ def sync_threaded(gui, ids, db, log=None, abort=None, notifications=None):
     password = prefs['password']
     formats_to_sync = prefs['formats']
     remove_html = prefs['remove_html']
+    upload_workers = prefs['upload_workers']
+    incremental = prefs['incremental']
     synced_ids = []
     failed_ids = list()
     no_format_ids = list()
@@ -109,7 +113,11 @@ def sync_threaded(gui, ids, db, log=None, abort=None, notifications=None):
         notifications.put((0.01, 'Syncing KyBook3'))
         thread = Thread(target = cal2ky3.main,
                         args = (library_path, content_server, username, password,
-                                remove_html, None, log_level, None, books))
+                                remove_html, None, log_level, None, books),
+                        kwargs = {'cache_dir': cache_dir,
+                                  'upload_workers': upload_workers,
+                                  'incremental': incremental,
+                                  'sql_trace': DEBUG})
         thread.daemon = True
         thread.start()
         address = ('localhost', 26564)
@@ -131,6 +139,10 @@ def sync_threaded(gui, ids, db, log=None, abort=None, notifications=None):
                                 failed_ids.append((book['id'], book['title']))
                             keep_running = False
                             break
+                        if 'failed' in data:
+                            # (book id, title) of books with failed uploads
+                            failed_ids += [tuple(f) for f in data['failed']]
+                            continue
                         notifications.put((data['count'] / data['total'],
                             _('%s %d of %d')%(data['pass'], data['count'], data['total'])))
                     else: